@@ -1,18 +1,27 @@
 """
 This script creates the database and fills it with sample data
+Usage: python db/init_db.py [branch ...]
+Each branch gets its own shard; "main" is db/library.db
 """
 import sqlite3
 import os
+import sys
 
-def init_database():
+def branch_db_path(branch_id):
+    """Shard file for a branch (same layout as server/branches.py)"""
+    if branch_id == "main":
+        return 'db/library.db'
+    return os.path.join('db', 'branches', f'{branch_id}.db')
+
+def init_database(db_path='db/library.db'):
     # Create db directory
-    os.makedirs('db', exist_ok=True)
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
     
     # Connect to SQLite database
-    conn = sqlite3.connect('db/library.db')
+    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
     
-    print("Creating library database...")
+    print(f"Creating library database {db_path}...")
     
     # Read and execute schema
     with open('db/schema.sql', 'r') as f:
@@ -20,11 +29,16 @@ def init_database():
     cursor.executescript(schema)
     print("Database tables created!")
     
-    # Read and execute seed data
-    with open('db/seed.sql', 'r') as f:
-        seed_data = f.read()
-    cursor.executescript(seed_data)
-    print("Sample data added!")
+    # Read and execute seed data (only into an empty database, so this script
+    # can be re-run to add new tables and indexes to an existing one)
+    cursor.execute("SELECT COUNT(*) FROM books")
+    if cursor.fetchone()[0] == 0:
+        with open('db/seed.sql', 'r') as f:
+            seed_data = f.read()
+        cursor.executescript(seed_data)
+        print("Sample data added!")
+    else:
+        print("Existing data kept, schema updated")
     
     # Verify the data
     cursor.execute("SELECT COUNT(*) FROM books")
@@ -47,4 +61,8 @@ def init_database():
     print("Database initialization complete!")
 
 if __name__ == "__main__":
-    init_database()
\ No newline at end of file
+    # Branches from the command line, else LIBRARY_BRANCHES, always including main
+    branches = sys.argv[1:] or os.getenv("LIBRARY_BRANCHES", "").split(",")
+    branches = ["main"] + [b.strip().lower() for b in branches if b.strip() and b.strip().lower() != "main"]
+    for branch_id in branches:
+        init_database(branch_db_path(branch_id))
\ No newline at end of file
@@ -57,4 +57,22 @@ CREATE TABLE IF NOT EXISTS tool_calls (
     args_json TEXT NOT NULL,         
     result_json TEXT NOT NULL,       
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
\ No newline at end of file
+);
+
+-- Indexes for filter_books (range filters + sorting done in SQL)
+CREATE INDEX IF NOT EXISTS idx_books_price_stock ON books(price, stock);
+CREATE INDEX IF NOT EXISTS idx_books_stock_price ON books(stock, price);
+
+-- Idempotency keys (a repeated /chat turn or order returns the stored result)
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    scope TEXT NOT NULL,             -- What the key is for: 'chat' or 'create_order'
+    key TEXT NOT NULL,               -- Key sent by the client (or derived per chat turn)
+    request_hash TEXT NOT NULL,      -- Fingerprint of the request, to catch key reuse
+    status TEXT NOT NULL DEFAULT 'pending', -- 'pending' while running, then 'done'
+    result_json TEXT,                -- Stored result once done
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at REAL NOT NULL,        -- Unix time after which the key is dropped: a short lease while pending, the TTL once done
+    PRIMARY KEY (scope, key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at);
@@ -3,11 +3,17 @@ LangChain agent setup
 """
 
 import os
+import json
+import threading
 from langchain.agents import AgentExecutor, create_tool_calling_agent
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.utils.function_calling import convert_to_openai_tool
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.tools import StructuredTool
+from llm import ModelRouter, parse_fake_models, router_settings_from_env
 from prompts import get_system_prompt
+from tool_output import shaped_tool
+from tool_selection import estimate_tokens, select_tools, selection_stats
 from tools import *
 from models import * 
 
@@ -15,8 +21,10 @@ from models import *
 from dotenv import load_dotenv
 load_dotenv()
 
-def setup_agent():
-    """Set up the LangChain agent with tools and Gemini model"""
+GEMINI_MODELS = ["gemini-2.0-flash", "gemini-1.5-flash", "gemini-1.5-pro", "gemini-pro"]
+
+def _gemini_models():
+    """Build every Gemini model we can, in fallback order"""
     
     # Get API key from environment
     google_api_key = os.getenv("GOOGLE_API_KEY")
@@ -26,48 +34,115 @@ def setup_agent():
     
     print(f"API Key loaded: {google_api_key[:10]}...")
     
-    # Initialize Gemini with the specified model
-    try:
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",  
-            temperature=0.1,
-            google_api_key=google_api_key
-        )
-        print("Using model: gemini-2.0-flash")
-    except Exception as e:
-        print(f"gemini-2.0-flash failed: {e}")
-        # Fallback to other models
+    models = []
+    for model_name in GEMINI_MODELS:
         try:
-            llm = ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash",
+            models.append((model_name, ChatGoogleGenerativeAI(
+                model=model_name,
                 temperature=0.1,
-                google_api_key=google_api_key
-            )
-            print("Using model: gemini-1.5-flash")
-        except Exception:
-            try:
-                llm = ChatGoogleGenerativeAI(
-                    model="gemini-1.5-pro",
-                    temperature=0.1,
-                    google_api_key=google_api_key
-                )
-                print("Using model: gemini-1.5-pro")
-            except Exception:
-                llm = ChatGoogleGenerativeAI(
-                    model="gemini-pro",
-                    temperature=0.1,
-                    google_api_key=google_api_key
-                )
-                print("Using model: gemini-pro")
+                google_api_key=google_api_key,
+                # The router enforces the overall deadline; keep provider retries short
+                timeout=float(os.getenv("LLM_TIMEOUT_SECONDS", "30")),
+                max_retries=int(os.getenv("LLM_MAX_RETRIES", "1"))
+            )))
+        except Exception as e:
+            print(f"{model_name} failed: {e}")
+    
+    if not models:
+        raise ValueError("No Gemini model could be initialized")
+    return models
+
+def build_agent_executor(llm, tools):
+    """Compile an agent executor for a given list of tools"""
+    
+    # Create the prompt template, with only the sections these tools need
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", get_system_prompt([tool.name for tool in tools])),
+        ("placeholder", "{chat_history}"),
+        ("human", "{input}"),
+        ("placeholder", "{agent_scratchpad}"),
+    ])
+    
+    # Create the agent
+    agent = create_tool_calling_agent(llm, tools, prompt)
+    
+    # Create the agent executor
+    return AgentExecutor(
+        agent=agent, 
+        tools=tools, 
+        verbose=True,
+        handle_parsing_errors=True,
+        return_intermediate_steps=True
+    )
+
+def estimate_prompt_tokens(tools):
+    """Approximate fixed input tokens per call: system prompt plus tool schemas"""
+    system_prompt = get_system_prompt([tool.name for tool in tools])
+    schemas = json.dumps([convert_to_openai_tool(tool) for tool in tools])
+    return estimate_tokens(system_prompt) + estimate_tokens(schemas)
+
+class AgentCache:
+    """Precompiled agent executors, one per tool subset, built on first use"""
+    
+    def __init__(self, llm, tools):
+        self.llm = llm
+        self.tools = {tool.name: tool for tool in tools}
+        self.all_tools = frozenset(self.tools)
+        self._executors = {}
+        self._lock = threading.Lock()
+        self.full = self.get(self.all_tools)
+    
+    def get(self, tool_names):
+        """Agent executor for exactly these tools"""
+        tool_names = frozenset(tool_names)
+        with self._lock:
+            executor = self._executors.get(tool_names)
+            if executor is None:
+                # Keep the original tool order so prompts stay stable
+                tools = [tool for name, tool in self.tools.items() if name in tool_names]
+                executor = build_agent_executor(self.llm, tools)
+                self._executors[tool_names] = executor
+                selection_stats.register_subset(tool_names, estimate_prompt_tokens(tools),
+                                                full=tool_names == self.all_tools)
+        return executor
+    
+    def for_message(self, message, context=()):
+        """
+        Pick tools for a user message, given the previous turn's messages;
+        returns (agent executor, tool names)
+        """
+        tool_names = select_tools(message, self.all_tools, context)
+        return self.get(tool_names), tool_names
+    
+def setup_agent():
+    """Set up the LangChain agent with tools and Gemini model"""
+    
+    # Fake models with injected delays/errors, for local resilience testing
+    fake_spec = os.getenv("LLM_FAKE_MODELS")
+    if fake_spec:
+        models = parse_fake_models(fake_spec)
+        print(f"Using fake models: {', '.join(name for name, _ in models)}")
+    else:
+        models = _gemini_models()
+    
+    # Route calls across the models with deadlines, hedging and circuit breaking
+    llm = ModelRouter(models, **router_settings_from_env())
+    print(f"Model routing order: {', '.join(llm.model_names)}")
     
     # Create tools for the agent using StructuredTool and existing models
     tools = [
         StructuredTool.from_function(
             func=find_books,
             name="find_books",
-            description="Search for books by title or author",
+            description="Search for books by title or author, at this branch or across all branches",
             args_schema=FindBooksRequest
         ),
+        StructuredTool.from_function(
+            func=filter_books,
+            name="filter_books",
+            description="Filter books by price range, stock range and author, with sorting and a result limit",
+            args_schema=FilterBooksRequest
+        ),
         StructuredTool.from_function(
             func=create_order,
             name="create_order",
@@ -92,6 +167,12 @@ def setup_agent():
             description="Check the status of an order",
             args_schema=OrderStatusInput
         ),
+        StructuredTool.from_function(
+            func=branch_stock,
+            name="branch_stock",
+            description="Check a book's stock and price at every library branch",
+            args_schema=BranchStockInput
+        ),
         StructuredTool.from_function(
             func=inventory_summary,
             name="inventory_summary",
@@ -100,28 +181,17 @@ def setup_agent():
         )
     ]
     
-    # Create the prompt template
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", get_system_prompt()),
-        ("placeholder", "{chat_history}"),
-        ("human", "{input}"),
-        ("placeholder", "{agent_scratchpad}"),
-    ])
-    
-    # Create the agent
-    agent = create_tool_calling_agent(llm, tools, prompt)
+    # The agent gets projected, truncated, compact tool output;
+    # the direct /tools/* endpoints call the unwrapped functions
+    for tool in tools:
+        tool.func = shaped_tool(tool.name, tool.func)
     
-    # Create the agent executor
-    agent_executor = AgentExecutor(
-        agent=agent, 
-        tools=tools, 
-        verbose=True,
-        handle_parsing_errors=True,
-        return_intermediate_steps=True
-    )
+    # Agents are compiled per tool subset; the full one is built up front
+    agents = AgentCache(llm, tools)
     
     print("AI Agent setup complete!")
-    return agent_executor
+    return agents, llm
 
 # Create a global agent instance
-agent_executor = setup_agent()
\ No newline at end of file
+agent_cache, llm_router = setup_agent()
+agent_executor = agent_cache.full
\ No newline at end of file
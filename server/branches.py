@@ -0,0 +1,141 @@
+"""
+Branch-aware database routing
+Each library branch has its own SQLite shard; requests pick one by branch id
+and cross-branch lookups fan out to every shard concurrently
+"""
+
+import os
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+from database import Database
+
+# The original single-file database is the "main" branch
+DEFAULT_BRANCH = "main"
+
+_BRANCH_ID = re.compile(r"^[a-z0-9][a-z0-9_-]{0,31}$")
+
+# Branch the current request is working against (read by the agent tools)
+current_branch: ContextVar[str] = ContextVar("current_branch", default=DEFAULT_BRANCH)
+
+
+def configured_branches() -> List[str]:
+    """Branch ids from LIBRARY_BRANCHES (comma separated), always including main"""
+    branches = [DEFAULT_BRANCH]
+    for branch_id in os.getenv("LIBRARY_BRANCHES", "").split(","):
+        branch_id = branch_id.strip().lower()
+        if branch_id and branch_id not in branches:
+            branches.append(branch_id)
+    return branches
+
+
+def branch_db_path(branch_id: str) -> str:
+    """db/library.db for main, db/branches/<id>.db for the rest (same layout as init_db.py)"""
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if branch_id == DEFAULT_BRANCH:
+        return os.path.join(project_root, "db", "library.db")
+    return os.path.join(project_root, "db", "branches", f"{branch_id}.db")
+
+
+def split_session_id(session_id: str) -> Tuple[Optional[str], str]:
+    """'north:abc' -> ('north', 'abc'); ids without a branch prefix -> (None, id)"""
+    branch_id, sep, rest = session_id.partition(":")
+    if sep and _BRANCH_ID.match(branch_id):
+        return branch_id, rest
+    return None, session_id
+
+
+class BranchRouter:
+    """Holds one Database per branch and routes calls to the right shard"""
+
+    def __init__(self, branches: Optional[List[str]] = None):
+        branches = branches or configured_branches()
+        for branch_id in branches:
+            if not _BRANCH_ID.match(branch_id):
+                raise ValueError(f"Invalid branch id '{branch_id}'")
+            if not os.path.exists(branch_db_path(branch_id)):
+                print(f"⚠️  No database for branch '{branch_id}', run: python db/init_db.py {branch_id}")
+        self.databases = {
+            branch_id: Database(branch_db_path(branch_id), branch_id=branch_id)
+            for branch_id in branches
+        }
+        self._pool = ThreadPoolExecutor(max_workers=max(1, len(branches)),
+                                        thread_name_prefix="branch-fanout")
+
+    @property
+    def branch_ids(self) -> List[str]:
+        return list(self.databases)
+
+    def resolve(self, branch_id: Optional[str]) -> str:
+        """Normalize a branch id, raising ValueError for unknown branches"""
+        branch_id = (branch_id or DEFAULT_BRANCH).lower()
+        if branch_id not in self.databases:
+            raise ValueError(f"Unknown branch '{branch_id}', known branches: {', '.join(self.branch_ids)}")
+        return branch_id
+
+    def get(self, branch_id: Optional[str] = None) -> Database:
+        """Database for a branch; defaults to the branch of the current request"""
+        return self.databases[self.resolve(branch_id or current_branch.get())]
+
+    def fan_out(self, method: str, *args, **kwargs) -> Tuple[Dict[str, Any], List[str]]:
+        """
+        Call the same Database method on every shard concurrently.
+        Returns (results per branch, branches that failed); one broken or
+        unprovisioned shard doesn't take the others down with it.
+        """
+        if len(self.databases) == 1:
+            futures = None
+        else:
+            futures = {
+                branch_id: self._pool.submit(getattr(db, method), *args, **kwargs)
+                for branch_id, db in self.databases.items()
+            }
+        results, failed = {}, []
+        for branch_id, db in self.databases.items():
+            try:
+                if futures is None:
+                    results[branch_id] = getattr(db, method)(*args, **kwargs)
+                else:
+                    results[branch_id] = futures[branch_id].result()
+            except sqlite3.Error as e:
+                print(f"⚠️  Branch '{branch_id}' failed in {method}: {e}")
+                failed.append(branch_id)
+        return results, failed
+
+    def find_books_all(self, query: str, search_by: str = "title") -> Tuple[List[Dict], List[str]]:
+        """find_books across every branch, each row tagged with its branch; also returns failed branches"""
+        results, failed = self.fan_out("find_books", query, search_by)
+        merged = []
+        for branch_id, books in results.items():
+            merged.extend({**book, 'branch': branch_id} for book in books)
+        merged.sort(key=lambda book: (book['title'], book['branch']))
+        return merged, failed
+
+    def stock_all(self, isbn: str) -> Tuple[List[Dict], List[str]]:
+        """Stock and price of one book at every branch that carries it; also returns failed branches"""
+        results, failed = self.fan_out("get_book", isbn)
+        stock = [
+            {'branch': branch_id, 'isbn': isbn, 'title': book['title'],
+             'stock': book['stock'], 'price': book['price']}
+            for branch_id, book in results.items()
+            if book
+        ]
+        return stock, failed
+
+
+@contextmanager
+def use_branch(branch_id: str):
+    """Run a block (e.g. tool calls) against one branch"""
+    token = current_branch.set(branch_id)
+    try:
+        yield
+    finally:
+        current_branch.reset(token)
+
+
+# Shared router for the server and the agent tools
+branch_router = BranchRouter()
@@ -0,0 +1,105 @@
+"""
+Compare per-turn tool selection with the full toolset
+Runs the same conversation turns through the full agent and through the agent
+picked by tool_selection.py, and prints input tokens and latency for both.
+
+Usage (from server/):
+    python compare_tool_selection.py [repeats]
+Uses Gemini when GOOGLE_API_KEY is set, with token counts from the model's usage
+metadata. Without a key it falls back to a fake model, which counts the exact
+prompt and tool schemas it was sent (about 4 characters per token); its latency
+is fixed, so only the Gemini run says anything about latency.
+Tools run against a temporary copy of the database, so library.db is untouched.
+"""
+
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+if not os.getenv("GOOGLE_API_KEY") and not os.getenv("LLM_FAKE_MODELS"):
+    os.environ["LLM_FAKE_MODELS"] = "fake:latency=0.05"
+
+from agent import agent_cache, llm_router
+from branches import branch_db_path, branch_router
+from database import Database
+
+# (previous user message, previous assistant message, message)
+SCENARIOS = [
+    (None, None, "Do you have any books by Robert C. Martin?"),
+    (None, None, "Show me books under $40 with at least 5 in stock, cheapest first"),
+    (None, None, "What's the status of order #3?"),
+    (None, None, "Which books are running low on stock?"),
+    (None, None, "We received 10 more copies of 978-0132350884, please restock"),
+    (None, None, "Change the price of 978-0134685991 to 45.99"),
+    (None, None, "Is Clean Code in stock at another branch?"),
+    ("I'd like 2 copies of Clean Code for customer 1",
+     "Clean Code has 15 copies in stock at $35.99. Shall I create the order for customer 1?",
+     "Yes, go ahead"),
+    ("Do you have The Pragmatic Programmer?",
+     "Yes, 'The Pragmatic Programmer' is in stock. Would you like to order a copy?",
+     "Yes, set that up for Alice"),
+]
+
+
+def input_tokens_so_far() -> int:
+    return sum(llm_router.stats[name].input_tokens for name in llm_router.model_names)
+
+
+def run_turn(executor, previous_user, previous_assistant, message):
+    """One agent turn; returns (input tokens, seconds)"""
+    chat_history = []
+    if previous_user:
+        chat_history = [("human", previous_user), ("ai", previous_assistant)]
+    tokens_before = input_tokens_so_far()
+    started = time.perf_counter()
+    executor.invoke({"input": message, "chat_history": chat_history})
+    return input_tokens_so_far() - tokens_before, time.perf_counter() - started
+
+
+def main(repeats: int = 3):
+    # Point the main branch at a scratch copy of the database
+    scratch_dir = tempfile.mkdtemp()
+    scratch_db = os.path.join(scratch_dir, "library.db")
+    shutil.copy(branch_db_path("main"), scratch_db)
+    branch_router.databases["main"] = Database(scratch_db, branch_id="main")
+
+    totals = {"full": [0, 0.0], "selected": [0, 0.0]}
+    print(f"{'message':<60} {'tools':>5} {'full tok':>9} {'sel tok':>8} {'full ms':>8} {'sel ms':>7}")
+    try:
+        for previous_user, previous_assistant, message in SCENARIOS:
+            context = [m for m in (previous_user, previous_assistant) if m]
+            selected, tool_names = agent_cache.for_message(message, context)
+            results = {"full": [], "selected": []}
+            for _ in range(repeats):
+                # Interleave the two so warm-up effects hit both sides equally
+                for mode, executor in (("full", agent_cache.full), ("selected", selected)):
+                    results[mode].append(run_turn(executor, previous_user, previous_assistant, message))
+
+            row = {}
+            for mode, runs in results.items():
+                tokens = statistics.mean(t for t, _ in runs)
+                seconds = statistics.median(s for _, s in runs)
+                totals[mode][0] += tokens
+                totals[mode][1] += seconds
+                row[mode] = (tokens, seconds)
+            print(f"{message[:60]:<60} {len(tool_names):>5} {row['full'][0]:>9.0f} {row['selected'][0]:>8.0f} "
+                  f"{row['full'][1] * 1000:>8.0f} {row['selected'][1] * 1000:>7.0f}")
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    full_tokens, full_seconds = totals["full"]
+    selected_tokens, selected_seconds = totals["selected"]
+    print()
+    if full_tokens:
+        print(f"Input tokens: {full_tokens:.0f} full vs {selected_tokens:.0f} selected "
+              f"({100 * (1 - selected_tokens / full_tokens):.1f}% fewer)")
+    else:
+        print("The model reported no token usage")
+    print(f"Latency (sum of medians): {full_seconds * 1000:.0f} ms full vs {selected_seconds * 1000:.0f} ms selected")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
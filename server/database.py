@@ -5,10 +5,17 @@ Database connection and operations
 import sqlite3
 import json
 import os
+import time
 from typing import List, Dict, Any
+from events import inventory_events
+from tool_output import ShapedOutput
 
 class Database:
-    def __init__(self, db_path: str = None):
+    # Sort keys allowed in filter_books
+    FILTER_SORT_COLUMNS = {"price", "stock", "title", "author"}
+    FILTER_MAX_LIMIT = 100
+    
+    def __init__(self, db_path: str = None, branch_id: str = "main"):
         # Use absolute path to avoid relative path issues
         if db_path is None:
             # Go up one level from server/ to project root, then to db/library.db
@@ -18,6 +25,9 @@ class Database:
         else:
             self.db_path = db_path
         
+        # Which library branch this shard belongs to (tags inventory events)
+        self.branch_id = branch_id
+        
         print(f"📁 Database path: {self.db_path}")  # Debug line
     
     def get_connection(self):
@@ -40,6 +50,59 @@ class Database:
         conn.close()
         return books
     
+    def filter_books(self, min_price: float = None, max_price: float = None,
+                     min_stock: int = None, max_stock: int = None, author: str = None,
+                     sort_by: str = "price", order: str = "asc", limit: int = 20) -> List[Dict]:
+        """Filter books by price/stock ranges and author, sorted and limited in SQL"""
+        sql, params = self._filter_books_query(min_price, max_price, min_stock, max_stock,
+                                               author, sort_by, order, limit)
+        conn = self.get_connection()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        books = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        return books
+    
+    def _filter_books_query(self, min_price, max_price, min_stock, max_stock,
+                            author, sort_by, order, limit):
+        """Build the filter_books SQL; only whitelisted names go into the string"""
+        if sort_by not in self.FILTER_SORT_COLUMNS:
+            raise ValueError(f"Cannot sort by '{sort_by}', use one of: {', '.join(sorted(self.FILTER_SORT_COLUMNS))}")
+        if order.lower() not in ("asc", "desc"):
+            raise ValueError("order must be 'asc' or 'desc'")
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        
+        conditions = []
+        params = []
+        if min_price is not None:
+            conditions.append("price >= ?")
+            params.append(min_price)
+        if max_price is not None:
+            conditions.append("price <= ?")
+            params.append(max_price)
+        if min_stock is not None:
+            conditions.append("stock >= ?")
+            params.append(min_stock)
+        if max_stock is not None:
+            conditions.append("stock <= ?")
+            params.append(max_stock)
+        if author:
+            # Case-insensitive substring match ("Martin" finds "Robert C. Martin");
+            # it can't use an index, so it runs on the rows the price/stock range leaves
+            escaped = author.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append("author LIKE ? ESCAPE '\\'")
+            params.append(f"%{escaped}%")
+        
+        sql = "SELECT * FROM books"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        # isbn as a tie-breaker keeps paging stable
+        sql += f" ORDER BY {sort_by} {order.upper()}, isbn LIMIT ?"
+        params.append(min(limit, self.FILTER_MAX_LIMIT))
+        return sql, params
+    
     def get_book(self, isbn: str) -> Dict:
         """Get a specific book by its ISBN"""
         conn = self.get_connection()
@@ -58,6 +121,8 @@ class Database:
         conn.commit()
         success = cursor.rowcount > 0
         conn.close()
+        if success:
+            inventory_events.publish(isbn, branch=self.branch_id, stock=new_stock)
         return success
     
     def update_book_price(self, isbn: str, new_price: float) -> bool:
@@ -68,6 +133,8 @@ class Database:
         conn.commit()
         success = cursor.rowcount > 0
         conn.close()
+        if success:
+            inventory_events.publish(isbn, branch=self.branch_id, price=new_price)
         return success
     
     # Order operations
@@ -101,6 +168,7 @@ class Database:
             order_id = cursor.lastrowid
             
             # Add order items and reduce stock
+            stock_changes = []
             for item in items:
                 book = self.get_book(item['isbn'])  # FIXED: isbn instead of ishn
                 cursor.execute(
@@ -110,8 +178,13 @@ class Database:
                 # Reduce stock
                 new_stock = book['stock'] - item['qty']
                 cursor.execute("UPDATE books SET stock = ? WHERE isbn = ?", (new_stock, item['isbn']))  # FIXED: isbn
+                stock_changes.append((item['isbn'], new_stock))
             
             conn.commit()
+            
+            # Only announce stock changes once they are committed
+            for isbn, new_stock in stock_changes:
+                inventory_events.publish(isbn, branch=self.branch_id, stock=new_stock)
             return order_id
             
         except Exception as e:
@@ -159,6 +232,76 @@ class Database:
         conn.close()
         return low_stock_books
     
+    # Idempotency key operations
+    def claim_idempotency_key(self, scope: str, key: str, request_hash: str, lease_seconds: float) -> Dict:
+        """
+        Try to claim a key for a new execution, holding it for `lease_seconds`.
+        Returns None if we claimed it, otherwise the existing row
+        (status 'pending' while another execution runs, 'done' with its result).
+        A pending key whose lease ran out (its worker died) is taken over.
+        """
+        conn = self.get_connection()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        now = time.time()
+        
+        # Cleanup rides along with claims (expires_at is indexed); this also
+        # frees pending keys whose lease expired, so the insert can take them over
+        cursor.execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (now,))
+        cursor.execute(
+            "INSERT OR IGNORE INTO idempotency_keys (scope, key, request_hash, status, expires_at) VALUES (?, ?, ?, 'pending', ?)",
+            (scope, key, request_hash, now + lease_seconds)
+        )
+        claimed = cursor.rowcount > 0
+        conn.commit()
+        
+        row = None
+        if not claimed:
+            cursor.execute(
+                "SELECT request_hash, status, result_json FROM idempotency_keys WHERE scope = ? AND key = ?",
+                (scope, key)
+            )
+            row = cursor.fetchone()
+        conn.close()
+        
+        if claimed:
+            return None
+        # Row vanished between the insert and the select (released or expired): report it as free to retry
+        return dict(row) if row else {'request_hash': request_hash, 'status': 'released', 'result_json': None}
+    
+    def renew_idempotency_key(self, scope: str, key: str, lease_seconds: float):
+        """Extend the lease of a key that is still being executed"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE idempotency_keys SET expires_at = ? WHERE scope = ? AND key = ? AND status = 'pending'",
+            (time.time() + lease_seconds, scope, key)
+        )
+        conn.commit()
+        conn.close()
+    
+    def complete_idempotency_key(self, scope: str, key: str, result: Any, ttl_seconds: float):
+        """Store the result for a claimed key and keep it for `ttl_seconds`"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE idempotency_keys SET status = 'done', result_json = ?, expires_at = ? WHERE scope = ? AND key = ?",
+            (json.dumps(result), time.time() + ttl_seconds, scope, key)
+        )
+        conn.commit()
+        conn.close()
+    
+    def release_idempotency_key(self, scope: str, key: str):
+        """Drop a pending key after a failed execution so a retry can run again"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM idempotency_keys WHERE scope = ? AND key = ? AND status = 'pending'",
+            (scope, key)
+        )
+        conn.commit()
+        conn.close()
+    
     # Chat storage operations
     def save_message(self, session_id: str, role: str, content: str):
         """Save a chat message"""
@@ -171,13 +314,16 @@ class Database:
         conn.commit()
         conn.close()
     
-    def save_tool_call(self, session_id: str, name: str, args: dict, result: dict):
+    def save_tool_call(self, session_id: str, name: str, args: dict, result: Any):
         """Save a tool call record"""
+        # Shaped tool output is already JSON; anything else (including plain strings
+        # such as the parsing-error observation) is encoded
+        result_json = result if isinstance(result, ShapedOutput) else json.dumps(result, default=str)
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO tool_calls (session_id, name, args_json, result_json) VALUES (?, ?, ?, ?)",
-            (session_id, name, json.dumps(args), json.dumps(result))
+            (session_id, name, json.dumps(args), result_json)
         )
         conn.commit()
         conn.close()
@@ -0,0 +1,150 @@
+"""
+Inventory change feed - an in-process event bus for stock and price changes
+Database write paths publish here; WebSocket/SSE endpoints subscribe
+"""
+
+import asyncio
+import os
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+
+# How long to wait after the first change before flushing, so bursts coalesce
+COALESCE_SECONDS = float(os.getenv("INVENTORY_COALESCE_MS", "250")) / 1000
+
+
+class InventorySubscription:
+    """
+    One subscriber's view of the feed.
+    Pending changes are kept per (branch, ISBN), so rapid updates to the same book
+    merge into a single delta instead of queueing up.
+    """
+
+    def __init__(self, bus: "InventoryEventBus", isbns: Optional[Iterable[str]] = None):
+        self.bus = bus
+        self.isbns: Optional[Set[str]] = set(isbns) if isbns else None  # None = every book
+        self.coalesced = 0
+        self._pending: Dict[tuple, Dict] = {}
+        self._ready = asyncio.Event()
+
+    def _push(self, event: Dict):
+        # The same ISBN at different branches is tracked separately
+        key = (event.get('branch'), event['isbn'])
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = dict(event)
+        else:
+            pending.update(event)
+            self.coalesced += 1
+        self._ready.set()
+
+    async def next_batch(self, coalesce: float = COALESCE_SECONDS,
+                         timeout: Optional[float] = None) -> List[Dict]:
+        """Wait for changes and return them; [] if `timeout` passes first"""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        if coalesce > 0:
+            await asyncio.sleep(coalesce)
+        batch = list(self._pending.values())
+        self._pending.clear()
+        self._ready.clear()
+        return batch
+
+    def subscribe(self, isbns: Iterable[str]):
+        """Add ISBNs to this subscription"""
+        if self.isbns is None:
+            # Already watching every book
+            return
+        self.bus._unindex(self)
+        self.isbns |= set(isbns)
+        self.bus._index(self)
+
+    def unsubscribe(self, isbns: Iterable[str]):
+        """Drop ISBNs from this subscription"""
+        if self.isbns is None:
+            return
+        self.bus._unindex(self)
+        self.isbns -= set(isbns)
+        self.bus._index(self)
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class InventoryEventBus:
+    """
+    Fan-out of inventory changes to subscribers.
+    Subscribers live on the event loop (no thread per client); publish() may be
+    called from any thread and hands the event over to the loop.
+    """
+
+    def __init__(self):
+        self._by_isbn: Dict[str, Set[InventorySubscription]] = defaultdict(set)
+        self._all: Set[InventorySubscription] = set()
+        self._count = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.published = 0
+
+    def subscribe(self, isbns: Optional[Iterable[str]] = None) -> InventorySubscription:
+        """Subscribe to some ISBNs, or to everything. Must run on the event loop."""
+        self._loop = asyncio.get_running_loop()
+        subscription = InventorySubscription(self, isbns)
+        self._index(subscription)
+        self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription: InventorySubscription):
+        self._unindex(subscription)
+        self._count -= 1
+
+    def _index(self, subscription: InventorySubscription):
+        if subscription.isbns is None:
+            self._all.add(subscription)
+        else:
+            for isbn in subscription.isbns:
+                self._by_isbn[isbn].add(subscription)
+
+    def _unindex(self, subscription: InventorySubscription):
+        self._all.discard(subscription)
+        for isbn in subscription.isbns or ():
+            subscribers = self._by_isbn.get(isbn)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._by_isbn[isbn]
+
+    def publish(self, isbn: str, **changes):
+        """Announce new values for a book, e.g. publish(isbn, branch="main", stock=4)"""
+        # Nothing listening: keep the write path free
+        if self._count == 0 or self._loop is None:
+            return
+        event = {'isbn': isbn, **changes, 'ts': time.time()}
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._dispatch(event)
+        elif not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._dispatch, event)
+
+    def _dispatch(self, event: Dict):
+        self.published += 1
+        for subscription in self._all:
+            subscription._push(event)
+        for subscription in self._by_isbn.get(event['isbn'], ()):
+            subscription._push(event)
+
+    def stats(self) -> Dict:
+        return {
+            'subscribers': self._count,
+            'watched_isbns': len(self._by_isbn),
+            'firehose_subscribers': len(self._all),
+            'events_published': self.published,
+        }
+
+
+# Shared bus for the whole process
+inventory_events = InventoryEventBus()
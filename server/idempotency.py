@@ -0,0 +1,151 @@
+"""
+Idempotency keys for chat turns and orders
+A repeated key returns the stored result instead of running again; a duplicate
+that arrives while the first execution is still running waits for it.
+A running execution holds its key on a short lease that it keeps renewing, so
+if the worker dies the key frees up quickly instead of staying pending.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# How long a stored result is kept, and how long a duplicate waits for the first run
+TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 60 * 60)))
+WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "120"))
+# Lease on a pending key; renewed every third of it while the execution runs
+LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "30"))
+POLL_SECONDS = 0.05
+
+# Id of the chat turn being processed; agent tools derive their keys from it
+current_turn: ContextVar[Optional[str]] = ContextVar("current_turn", default=None)
+
+
+class IdempotencyConflict(ValueError):
+    """The key was already used for a different request"""
+
+
+class IdempotencyInProgress(RuntimeError):
+    """The first execution for this key did not finish in time"""
+
+
+def request_fingerprint(payload: Any) -> str:
+    """Stable hash of a request body"""
+    encoded = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+# In-process executions, so local duplicates wake up as soon as the first one ends
+_inflight: Dict[Tuple[str, str, str], threading.Event] = {}
+_inflight_lock = threading.Lock()
+
+
+def _begin(db, scope: str, key: str, request_hash: str) -> Optional[Dict]:
+    row = db.claim_idempotency_key(scope, key, request_hash, LEASE_SECONDS)
+    if row is None:
+        with _inflight_lock:
+            _inflight[(db.db_path, scope, key)] = threading.Event()
+        return None
+    if row['request_hash'] != request_hash:
+        raise IdempotencyConflict(f"Idempotency key '{key}' was already used for a different request")
+    return row
+
+
+def _finish(db, scope: str, key: str, result: Any = None, failed: bool = False):
+    if failed:
+        db.release_idempotency_key(scope, key)
+    else:
+        db.complete_idempotency_key(scope, key, result, TTL_SECONDS)
+    with _inflight_lock:
+        event = _inflight.pop((db.db_path, scope, key), None)
+    if event is not None:
+        event.set()
+
+
+def _inflight_event(db, scope: str, key: str) -> Optional[threading.Event]:
+    with _inflight_lock:
+        return _inflight.get((db.db_path, scope, key))
+
+
+def _keep_lease(db, scope: str, key: str, stop: threading.Event):
+    while not stop.wait(LEASE_SECONDS / 3):
+        db.renew_idempotency_key(scope, key, LEASE_SECONDS)
+
+
+def _run_claimed(db, scope: str, key: str, func: Callable[[], Any]) -> Any:
+    """Run func for a key we hold, renewing its lease; store the result or release the key"""
+    stop = threading.Event()
+    threading.Thread(target=_keep_lease, args=(db, scope, key, stop),
+                     name="idempotency-lease", daemon=True).start()
+    try:
+        result = func()
+    except BaseException:
+        stop.set()
+        _finish(db, scope, key, failed=True)
+        raise
+    stop.set()
+    _finish(db, scope, key, result)
+    return result
+
+
+def _replay(row: Dict) -> Optional[Tuple[Any, bool]]:
+    """The stored result of a finished key; None while it is still pending"""
+    if row['status'] == 'done':
+        return json.loads(row['result_json']), True
+    return None
+
+
+def _attempt(db, scope: str, key: str, request_hash: str,
+             func: Callable[[], Any]) -> Optional[Tuple[Any, bool]]:
+    """One try: run func if we claim the key, replay if it is done; None means wait"""
+    row = _begin(db, scope, key, request_hash)
+    if row is None:
+        return _run_claimed(db, scope, key, func), False
+    return _replay(row)
+
+
+def run_idempotent(db, scope: str, key: str, payload: Any, func: Callable[[], Any]) -> Tuple[Any, bool]:
+    """
+    Run func once per (scope, key).
+    Returns (result, replayed); replayed is True when the stored result was returned.
+    """
+    request_hash = request_fingerprint(payload)
+    deadline = time.monotonic() + WAIT_SECONDS
+    while True:
+        outcome = _attempt(db, scope, key, request_hash, func)
+        if outcome is not None:
+            return outcome
+        if time.monotonic() >= deadline:
+            raise IdempotencyInProgress(f"Request with idempotency key '{key}' is still in progress")
+        event = _inflight_event(db, scope, key)
+        if event is not None:
+            event.wait(POLL_SECONDS)
+        else:
+            # Running in another process: poll the table
+            time.sleep(POLL_SECONDS)
+
+
+async def run_idempotent_async(db, scope: str, key: str, payload: Any,
+                               func: Callable[[], Any]) -> Tuple[Any, bool]:
+    """
+    Same as run_idempotent for async endpoints: func and the database calls run
+    in worker threads (with the caller's context vars) and waiting is an
+    asyncio sleep, so the event loop is never blocked
+    """
+    request_hash = request_fingerprint(payload)
+    deadline = time.monotonic() + WAIT_SECONDS
+    while True:
+        row = await asyncio.to_thread(_begin, db, scope, key, request_hash)
+        if row is None:
+            return await asyncio.to_thread(_run_claimed, db, scope, key, func), False
+        outcome = _replay(row)
+        if outcome is not None:
+            return outcome
+        if time.monotonic() >= deadline:
+            raise IdempotencyInProgress(f"Request with idempotency key '{key}' is still in progress")
+        await asyncio.sleep(POLL_SECONDS)
@@ -0,0 +1,416 @@
+"""
+LLM call resilience - deadlines, hedged requests and circuit breaking
+Wraps several chat models so one slow or failing model can't hang /chat
+"""
+
+import os
+import copy
+import json
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import Runnable
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+
+class LLMUnavailableError(RuntimeError):
+    """Raised when no model produced an answer before the deadline"""
+
+
+class ModelStats:
+    """Rolling latency and error counters for one model"""
+
+    def __init__(self, window: int = 200):
+        self.latencies = deque(maxlen=window)
+        self.calls = 0
+        self.successes = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.input_tokens = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def record_success(self, latency: float, input_tokens: int = 0):
+        with self._lock:
+            self.calls += 1
+            self.successes += 1
+            self.input_tokens += input_tokens
+            self.latencies.append(latency)
+
+    def record_error(self, latency: float, error: Exception):
+        # Failed calls stay out of the latency window: a fast error would
+        # otherwise pull the hedge percentile down
+        with self._lock:
+            self.calls += 1
+            self.errors += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def record_hedge(self):
+        with self._lock:
+            self.hedges += 1
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Latency at percentile p (0-100), or None without samples"""
+        with self._lock:
+            samples = sorted(self.latencies)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def snapshot(self) -> Dict[str, Any]:
+        p50, p95, p99 = self.percentile(50), self.percentile(95), self.percentile(99)
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'successes': self.successes,
+                'errors': self.errors,
+                'timeouts': self.timeouts,
+                'hedges': self.hedges,
+                'input_tokens': self.input_tokens,
+                'samples': len(self.latencies),
+                'p50_ms': round(p50 * 1000, 1) if p50 is not None else None,
+                'p95_ms': round(p95 * 1000, 1) if p95 is not None else None,
+                'p99_ms': round(p99 * 1000, 1) if p99 is not None else None,
+                'last_error': self.last_error,
+            }
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and stays open for
+    `reset_timeout` seconds; then lets a single trial call through (half-open)
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        """Whether a call could go through now, without taking the trial slot"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            return self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def allow_request(self) -> bool:
+        """Take permission for a call that is about to be made"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Let exactly one trial call through
+                self.state = "half_open"
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'state': self.state, 'consecutive_failures': self.failures}
+
+
+class ModelRouter(Runnable):
+    """
+    Calls an ordered list of chat models with a per-call deadline.
+
+    - The first model whose circuit is closed is the primary
+    - If the primary hasn't answered after its own p`hedge_percentile` latency,
+      a hedged request goes to the next model and the first answer wins
+    - If a model errors, the next model is tried right away
+    - Models whose circuit is open are skipped until their cooldown passes
+    - Only calls that actually reached a model count as its timeouts; calls
+      still queued for a worker when the deadline passes are cancelled
+    """
+
+    def __init__(
+        self,
+        models: List[Tuple[str, Any]],
+        timeout: float = 30.0,
+        hedge_percentile: float = 95.0,
+        hedge_min_samples: int = 20,
+        failure_threshold: int = 3,
+        reset_timeout: float = 30.0,
+        max_concurrent_calls: int = 32,
+        _shared: Optional[Dict[str, Any]] = None,
+    ):
+        if not models:
+            raise ValueError("ModelRouter needs at least one model")
+        self.models = models
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_concurrent_calls = max_concurrent_calls
+
+        # Stats, breakers and the thread pool are shared with bound copies.
+        # The pool is sized for concurrent invokes (chat turns), with room for
+        # one hedge each, so normal load doesn't queue behind it
+        if _shared is None:
+            _shared = {
+                'stats': {name: ModelStats() for name, _ in models},
+                'breakers': {
+                    name: CircuitBreaker(failure_threshold, reset_timeout) for name, _ in models
+                },
+                'pool': ThreadPoolExecutor(max_workers=2 * max_concurrent_calls,
+                                           thread_name_prefix="llm-call"),
+            }
+        self._shared = _shared
+        self.stats = _shared['stats']
+        self.breakers = _shared['breakers']
+        self._pool = _shared['pool']
+
+    @property
+    def model_names(self) -> List[str]:
+        return [name for name, _ in self.models]
+
+    def bind_tools(self, tools, **kwargs) -> "ModelRouter":
+        """Bind tools on every underlying model, keeping shared stats"""
+        bound = [(name, model.bind_tools(tools, **kwargs)) for name, model in self.models]
+        return ModelRouter(
+            bound,
+            timeout=self.timeout,
+            hedge_percentile=self.hedge_percentile,
+            hedge_min_samples=self.hedge_min_samples,
+            failure_threshold=self.failure_threshold,
+            reset_timeout=self.reset_timeout,
+            max_concurrent_calls=self.max_concurrent_calls,
+            _shared=self._shared,
+        )
+
+    def _candidates(self) -> Tuple[List[Tuple[str, Any]], bool]:
+        """
+        Models that may be called, in order, and whether the breakers are bypassed.
+        Only checks the breakers; the half-open trial slot is taken at launch.
+        """
+        available = [(name, model) for name, model in self.models
+                     if self.breakers[name].available()]
+        if available:
+            return available, False
+        # Every circuit is open: try them all anyway rather than failing outright
+        return list(self.models), True
+
+    def _hedge_delay(self, name: str) -> Optional[float]:
+        if self.hedge_percentile <= 0:
+            return None
+        stats = self.stats[name]
+        if len(stats.latencies) < self.hedge_min_samples:
+            return None
+        return stats.percentile(self.hedge_percentile)
+
+    def _call(self, name: str, model: Any, input: Any, config: Any, deadline: float,
+              started: threading.Event):
+        if time.monotonic() >= deadline:
+            # Waited in the pool until the caller gave up: the model was never asked
+            raise LLMUnavailableError(f"Call to {name} did not start before the deadline")
+        started.set()
+        start = time.monotonic()
+        try:
+            result = model.invoke(input, config)
+        except Exception as e:
+            self.stats[name].record_error(time.monotonic() - start, e)
+            if time.monotonic() < deadline:
+                self.breakers[name].record_failure()
+            raise
+        # Providers report prompt size in usage_metadata (fake models estimate it)
+        usage = getattr(result, "usage_metadata", None) or {}
+        self.stats[name].record_success(time.monotonic() - start, usage.get("input_tokens", 0))
+        # A late answer was already counted as a timeout; don't close the circuit on it
+        if time.monotonic() < deadline:
+            self.breakers[name].record_success()
+        return result
+
+    def invoke(self, input: Any, config: Optional[Dict] = None, **kwargs) -> Any:
+        candidates, bypass_breakers = self._candidates()
+        deadline = time.monotonic() + self.timeout
+        pending = {}
+        last_error = None
+        next_index = 0
+        launched_at = 0.0
+
+        def launch_next() -> Optional[str]:
+            """Start the next candidate whose breaker lets it through; returns its name"""
+            nonlocal next_index, launched_at
+            while next_index < len(candidates):
+                name, model = candidates[next_index]
+                next_index += 1
+                # A concurrent call may have taken the half-open trial in the meantime
+                if bypass_breakers or self.breakers[name].allow_request():
+                    started = threading.Event()
+                    future = self._pool.submit(self._call, name, model, input, config, deadline, started)
+                    pending[future] = (name, started)
+                    launched_at = time.monotonic()
+                    return name
+            return None
+
+        primary = launch_next()
+        if primary is None:
+            raise LLMUnavailableError("No model is accepting calls right now (circuits open)")
+        hedge_delay = self._hedge_delay(primary)
+
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+
+            wait_for = deadline - now
+            if hedge_delay is not None and next_index < len(candidates):
+                wait_for = min(wait_for, max(0.0, launched_at + hedge_delay - now))
+
+            done, _ = wait(list(pending), timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                # Calls still queued behind the winner are no longer needed
+                for other in pending:
+                    other.cancel()
+                return result
+
+            if next_index < len(candidates):
+                if not pending:
+                    # Everything in flight failed: fall back immediately
+                    launch_next()
+                elif hedge_delay is not None and time.monotonic() >= launched_at + hedge_delay:
+                    name = launch_next()
+                    if name is not None:
+                        self.stats[name].record_hedge()
+                        print(f"Hedging LLM call to {name}")
+
+        # Calls still queued never reached their model: cancel them and don't
+        # blame the model. Whatever was running missed the deadline.
+        timed_out = []
+        for future, (name, started) in pending.items():
+            if future.cancel() or not started.is_set():
+                continue
+            self.stats[name].record_timeout()
+            self.breakers[name].record_failure()
+            timed_out.append(name)
+
+        if timed_out:
+            raise LLMUnavailableError(
+                f"No model answered within {self.timeout}s (tried: {', '.join(timed_out)})"
+            )
+        if pending:
+            raise LLMUnavailableError(
+                f"No model could be called within {self.timeout}s (all LLM workers busy)"
+            )
+        raise LLMUnavailableError(f"All models failed, last error: {last_error}") from last_error
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Per-model latency, error and circuit state"""
+        return {
+            'timeout_s': self.timeout,
+            'hedge_percentile': self.hedge_percentile,
+            'models': {
+                name: {
+                    **self.stats[name].snapshot(),
+                    'hedge_after_ms': (round(self._hedge_delay(name) * 1000, 1)
+                                       if self._hedge_delay(name) is not None else None),
+                    'circuit': self.breakers[name].snapshot(),
+                }
+                for name in self.model_names
+            },
+        }
+
+
+class FakeChatModel:
+    """
+    Local stand-in for a chat model that injects latency and errors.
+    Used to exercise the router without calling a real provider.
+    """
+
+    def __init__(self, name: str, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, response: str = None):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.response = response or f"[{name}] This is a canned response from a fake model."
+        self.tool_schemas = ""
+
+    def bind_tools(self, tools, **kwargs) -> "FakeChatModel":
+        # The fake never calls tools; it only keeps the schemas to count them as input
+        bound = copy.copy(self)
+        bound.tool_schemas = json.dumps([convert_to_openai_tool(tool) for tool in tools])
+        return bound
+
+    def _estimate_input_tokens(self, input: Any) -> int:
+        text = input.to_string() if hasattr(input, "to_string") else str(input)
+        # About 4 characters per token
+        return (len(text) + len(self.tool_schemas)) // 4
+
+    def invoke(self, input: Any, config: Optional[Dict] = None, **kwargs) -> AIMessage:
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < self.error_rate:
+            raise RuntimeError(f"Injected failure from fake model {self.name}")
+        input_tokens = self._estimate_input_tokens(input)
+        output_tokens = len(self.response) // 4
+        return AIMessage(content=self.response, usage_metadata={
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'total_tokens': input_tokens + output_tokens,
+        })
+
+
+def parse_fake_models(spec: str) -> List[Tuple[str, FakeChatModel]]:
+    """
+    Build fake models from a spec like
+    "slow:latency=3:error_rate=0.2,fast:latency=0.2:jitter=0.1"
+    """
+    models = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, *options = entry.split(":")
+        kwargs = {}
+        for option in options:
+            key, _, value = option.partition("=")
+            kwargs[key] = value if key == "response" else float(value)
+        models.append((name, FakeChatModel(name, **kwargs)))
+    return models
+
+
+def router_settings_from_env() -> Dict[str, Any]:
+    """Read router tuning knobs from the environment"""
+    return {
+        'timeout': float(os.getenv("LLM_TIMEOUT_SECONDS", "30")),
+        'hedge_percentile': float(os.getenv("LLM_HEDGE_PERCENTILE", "95")),
+        'hedge_min_samples': int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20")),
+        'failure_threshold': int(os.getenv("LLM_BREAKER_FAILURES", "3")),
+        'reset_timeout': float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30")),
+        # /chat turns run on asyncio's default thread pool, which has at most 32 threads
+        'max_concurrent_calls': int(os.getenv("LLM_MAX_CONCURRENT_CALLS", "32")),
+    }
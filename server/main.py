@@ -2,19 +2,30 @@
 FastAPI Server - The main application
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
+import asyncio
+import json
+import secrets
+import time
 import uuid
 import os
 
 # Import components
-from database import Database
-from agent import agent_executor
+from branches import branch_router, current_branch, split_session_id, use_branch
+from agent import agent_cache, llm_router
+from llm import LLMUnavailableError
+from events import inventory_events
+from idempotency import (IdempotencyConflict, IdempotencyInProgress, current_turn,
+                         run_idempotent_async)
+from profiling import ProfilingMiddleware, request_profiles, sampling_profiler
+from tool_selection import selection_stats
 from models import *
+from tools import branch_stock, create_order, inventory_summary, order_status
 
 app = FastAPI(title="Library Desk Agent", version="1.0.0")
 
@@ -27,7 +38,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-db = Database()
+# Count requests for the sampling profiler (no-op unless profiling is on)
+app.add_middleware(ProfilingMiddleware, profiler=sampling_profiler)
 
 # Serve frontend files
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -44,13 +56,25 @@ else:
 # Chat request model
 class ChatRequest(BaseModel):
     message: str
-    session_id: Optional[str] = None
+    session_id: Optional[str] = None  # "<branch>:<id>" for sessions we created
+    branch_id: Optional[str] = None  # branch for a new session, defaults to main
 
 class ChatResponse(BaseModel):
     response: str
     session_id: str
+    branch_id: str
     tools_used: List[str] = []
 
+# Admin access - admin endpoints are disabled unless ADMIN_TOKEN is set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def _is_admin(token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN) and token is not None and secrets.compare_digest(token, ADMIN_TOKEN)
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not _is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
 @app.get("/")
 async def root():
     return {"message": "Library Desk Agent API is running! Go to /app/ for the chat interface."}
@@ -64,95 +88,367 @@ async def serve_frontend():
     else:
         return {"error": "Frontend not found. Please check if the app folder exists."}
 
+def _run_chat_turn(db, session_id: str, branch_id: str, message: str,
+                   response: Response, profile: bool) -> dict:
+    """Run one chat turn through the agent and store it; returns the ChatResponse fields"""
+    
+    # Get chat history for context
+    history = db.get_chat_history(session_id)
+    
+    # Prepare conversation history for the agent
+    chat_history = []
+    for msg in history:
+        if msg['role'] == 'user':
+            chat_history.append(("human", msg['content']))
+        else:
+            chat_history.append(("ai", msg['content']))
+    
+    # Save user message
+    db.save_message(session_id, "user", message)
+    
+    # Pick the tools this message needs (the previous user and assistant
+    # messages count too, for follow-ups) and the agent compiled for them
+    previous_turn = [msg['content'] for msg in history[-2:]]
+    agent_executor, tool_names = agent_cache.for_message(message, previous_turn)
+    
+    # Invoke the agent
+    started = time.perf_counter()
+    agent_input = {
+        "input": message,
+        "chat_history": chat_history
+    }
+    if profile:
+        # One-off deterministic profile, fetch it from /admin/profile/runs/{id}
+        result, run_id = request_profiles.profile(agent_executor.invoke, agent_input)
+        response.headers["X-Profile-Id"] = run_id
+    else:
+        result = agent_executor.invoke(agent_input)
+    selection_stats.record(tool_names, time.perf_counter() - started)
+    
+    response_text = result.get("output", "I apologize, but I couldn't process your request.")
+    
+    # Save AI response
+    db.save_message(session_id, "assistant", response_text)
+    
+    # Track which tools were used (for response)
+    tools_used = []
+    if "intermediate_steps" in result:
+        for step in result["intermediate_steps"]:
+            tool_name = step[0].tool
+            tools_used.append(tool_name)
+            
+            # Save tool call to database
+            db.save_tool_call(
+                session_id=session_id,
+                name=tool_name,
+                args=step[0].tool_input,
+                result=step[1]
+            )
+    
+    return ChatResponse(
+        response=response_text,
+        session_id=session_id,
+        branch_id=branch_id,
+        tools_used=tools_used
+    ).model_dump()
+
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, response: Response,
+               idempotency_key: Optional[str] = Header(None),
+               x_profile: Optional[str] = Header(None),
+               x_admin_token: Optional[str] = Header(None)):
     """Main chat endpoint - talk to the AI librarian"""
     
-    # Generate session ID if not provided
-    session_id = request.session_id or str(uuid.uuid4())
+    # The branch comes from the session id prefix, else the request, else main
+    session_branch = split_session_id(request.session_id)[0] if request.session_id else None
+    if session_branch and request.branch_id and session_branch != request.branch_id.lower():
+        raise HTTPException(status_code=400, detail=f"Session belongs to branch '{session_branch}'")
+    try:
+        branch_id = branch_router.resolve(session_branch or request.branch_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    db = branch_router.get(branch_id)
+    
+    # Generate session ID if not provided, tagged with its branch
+    session_id = request.session_id or f"{branch_id}:{uuid.uuid4()}"
+    
+    def run_turn():
+        return _run_chat_turn(db, session_id, branch_id, request.message, response,
+                              profile=bool(x_profile) and _is_admin(x_admin_token))
     
+    # Agent tools read the branch and turn from here; tool calls in a retried
+    # turn reuse the same turn id, so they replay instead of running twice
+    branch_token = current_branch.set(branch_id)
+    turn_token = current_turn.set(idempotency_key or str(uuid.uuid4()))
     try:
-        # Get chat history for context
-        history = db.get_chat_history(session_id)
-        
-        # Prepare conversation history for the agent
-        chat_history = []
-        for msg in history:
-            if msg['role'] == 'user':
-                chat_history.append(("human", msg['content']))
-            else:
-                chat_history.append(("ai", msg['content']))
-        
-        # Save user message
-        db.save_message(session_id, "user", request.message)
-        
-        # Invoke the agent
-        result = agent_executor.invoke({
-            "input": request.message,
-            "chat_history": chat_history
-        })
-        
-        response_text = result.get("output", "I apologize, but I couldn't process your request.")
-        
-        # Save AI response
-        db.save_message(session_id, "assistant", response_text)
-        
-        # Track which tools were used (for response)
-        tools_used = []
-        if "intermediate_steps" in result:
-            for step in result["intermediate_steps"]:
-                tool_name = step[0].tool
-                tools_used.append(tool_name)
-                
-                # Save tool call to database
-                db.save_tool_call(
-                    session_id=session_id,
-                    name=tool_name,
-                    args=step[0].tool_input,
-                    result=step[1]
-                )
-        
-        return ChatResponse(
-            response=response_text,
-            session_id=session_id,
-            tools_used=tools_used
-        )
+        if idempotency_key:
+            # A retried turn returns the stored response without re-running the agent
+            payload = {"message": request.message, "session_id": request.session_id, "branch_id": branch_id}
+            result, replayed = await run_idempotent_async(db, "chat", idempotency_key, payload, run_turn)
+            if replayed:
+                response.headers["Idempotent-Replayed"] = "true"
+        else:
+            # The agent turn blocks on the model, so keep it off the event loop
+            # (to_thread copies the branch and turn context vars)
+            result = await asyncio.to_thread(run_turn)
+        return ChatResponse(**result)
         
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except IdempotencyInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except LLMUnavailableError as e:
+        raise HTTPException(status_code=503, detail=f"Language model unavailable: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing chat: {str(e)}")
+    finally:
+        current_turn.reset(turn_token)
+        current_branch.reset(branch_token)
+
+# Tool endpoints - the branch comes from the X-Branch-Id header (default: main)
+def request_branch(x_branch_id: Optional[str] = Header(None)) -> str:
+    try:
+        return branch_router.resolve(x_branch_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/branches")
+async def api_branches():
+    """Configured library branches"""
+    return {"branches": branch_router.branch_ids}
 
-# Tool endpoints 
 @app.post("/tools/find_books")
-async def api_find_books(request: FindBooksRequest):
+async def api_find_books(request: FindBooksRequest, branch: str = Depends(request_branch)):
     """Direct endpoint to search books"""
-    books = db.find_books(request.q, request.by)
+    if request.all_branches:
+        books, failed_branches = branch_router.find_books_all(request.q, request.by)
+        return {"books": books, "failed_branches": failed_branches}
+    books = branch_router.get(branch).find_books(request.q, request.by)
+    return {"books": books}
+
+@app.post("/tools/filter_books")
+async def api_filter_books(request: FilterBooksRequest, branch: str = Depends(request_branch)):
+    """Direct endpoint to filter books by price/stock ranges and author"""
+    try:
+        books = branch_router.get(branch).filter_books(**request.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"books": books}
 
 @app.post("/tools/create_order")
-async def api_create_order(request: CreateOrderRequest):
-    """Direct endpoint to create orders"""
+async def api_create_order(request: CreateOrderRequest, branch: str = Depends(request_branch),
+                           idempotency_key: Optional[str] = Header(None)):
+    """Direct endpoint to create orders (send Idempotency-Key to make retries safe)"""
+    # Convert to the format expected by the tool
+    items_dict = [{"isbn": item.isbn, "qty": item.qty} for item in request.items]
+    
+    def place_order():
+        return create_order(customer_id=request.customer_id, items=items_dict)
+    
     try:
-        # Convert to the format expected by the tool
-        items_dict = [{"isbn": item.isbn, "qty": item.qty} for item in request.items]
-        result = create_order({"customer_id": request.customer_id, "items": items_dict})
+        with use_branch(branch):
+            if idempotency_key:
+                # Same scope and payload as the agent's create_order tool, so either can replay the other
+                payload = {'customer_id': request.customer_id, 'items': items_dict}
+                result, _ = await run_idempotent_async(branch_router.get(branch), "create_order",
+                                                       idempotency_key, payload, place_order)
+            else:
+                result = await asyncio.to_thread(place_order)
         return result
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except IdempotencyInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/tools/order_status/{order_id}")
-async def api_order_status(order_id: int):
+async def api_order_status(order_id: int, branch: str = Depends(request_branch)):
     """Direct endpoint to check order status"""
-    result = order_status({"order_id": order_id})
+    with use_branch(branch):
+        result = order_status(order_id=order_id)
     if "error" in result:
         raise HTTPException(status_code=404, detail=result["error"])
     return result
 
 @app.get("/tools/inventory_summary")
-async def api_inventory_summary():
+async def api_inventory_summary(branch: str = Depends(request_branch)):
     """Direct endpoint to get low stock books"""
-    result = inventory_summary()
+    with use_branch(branch):
+        result = inventory_summary()
     return result
 
+@app.get("/tools/branch_stock/{isbn}")
+async def api_branch_stock(isbn: str):
+    """Direct endpoint to see a book's stock at every branch"""
+    result = branch_stock(isbn=isbn)
+    if "error" in result:
+        raise HTTPException(status_code=404, detail=result["error"])
+    return result
+
+@app.get("/llm/stats")
+async def api_llm_stats():
+    """Per-model latency, error and circuit breaker stats"""
+    return llm_router.snapshot()
+
+# Live inventory feed
+SSE_KEEPALIVE_SECONDS = 15
+
+def _parse_isbns(isbn: Optional[str]) -> Optional[List[str]]:
+    """'a,b' -> ['a', 'b']; empty means every book"""
+    if not isbn:
+        return None
+    return [part.strip() for part in isbn.split(",") if part.strip()]
+
+def _inventory_snapshot(isbns: Optional[List[str]]) -> dict:
+    """Current stock and price of the watched books at every branch, sent once on connect"""
+    books, failed_branches = [], set()
+    for isbn in isbns or []:
+        stock, failed = branch_router.stock_all(isbn)
+        books.extend(stock)
+        failed_branches.update(failed)
+    return {"books": books, "failed_branches": sorted(failed_branches)}
+
+def _parse_inventory_command(text: str) -> dict:
+    """
+    Validate a WebSocket frame: a JSON object whose "subscribe"/"unsubscribe"
+    values are lists of ISBN strings. Raises ValueError for anything else.
+    """
+    try:
+        command = json.loads(text)
+    except json.JSONDecodeError:
+        raise ValueError("Commands must be JSON")
+    if not isinstance(command, dict):
+        raise ValueError('Commands must be objects like {"subscribe": ["978-..."]}')
+    parsed = {}
+    for action in ("subscribe", "unsubscribe"):
+        isbns = command.get(action)
+        if isbns is None:
+            continue
+        if not isinstance(isbns, list) or not all(isinstance(i, str) and i.strip() for i in isbns):
+            raise ValueError(f'"{action}" must be a list of ISBN strings')
+        parsed[action] = [i.strip() for i in isbns]
+    if not parsed:
+        raise ValueError('Expected "subscribe" or "unsubscribe"')
+    return parsed
+
+@app.websocket("/ws/inventory")
+async def ws_inventory(websocket: WebSocket, isbn: Optional[str] = None):
+    """
+    Push stock/price changes over a WebSocket.
+    ?isbn=a,b limits the feed; clients can send {"subscribe": [...]} or
+    {"unsubscribe": [...]} to change it while connected.
+    """
+    await websocket.accept()
+    isbns = _parse_isbns(isbn)
+    subscription = inventory_events.subscribe(isbns)
+
+    async def send_changes():
+        while True:
+            changes = await subscription.next_batch()
+            await websocket.send_json({"type": "inventory", "changes": changes})
+
+    async def receive_commands():
+        while True:
+            try:
+                command = _parse_inventory_command(await websocket.receive_text())
+            except ValueError as e:
+                # Reject the frame but keep the connection
+                await websocket.send_json({"type": "error", "detail": str(e)})
+                continue
+            if command.get("subscribe"):
+                subscription.subscribe(command["subscribe"])
+                snapshot = await asyncio.to_thread(_inventory_snapshot, command["subscribe"])
+                await websocket.send_json({"type": "snapshot", **snapshot})
+            if command.get("unsubscribe"):
+                subscription.unsubscribe(command["unsubscribe"])
+
+    tasks = []
+    try:
+        # The snapshot reads every shard; keep that SQLite work off the event loop
+        snapshot = await asyncio.to_thread(_inventory_snapshot, isbns)
+        await websocket.send_json({"type": "snapshot", **snapshot})
+        tasks = [asyncio.create_task(send_changes()), asyncio.create_task(receive_commands())]
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not isinstance(task.exception(), WebSocketDisconnect):
+                task.result()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        subscription.close()
+
+@app.get("/events/inventory")
+async def sse_inventory(isbn: Optional[str] = Query(None)):
+    """Server-Sent Events version of the inventory feed (?isbn=a,b to filter)"""
+    isbns = _parse_isbns(isbn)
+
+    async def stream():
+        # Subscribe inside the generator so cleanup always runs with it
+        subscription = inventory_events.subscribe(isbns)
+        try:
+            snapshot = await asyncio.to_thread(_inventory_snapshot, isbns)
+            yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+            while True:
+                changes = await subscription.next_batch(timeout=SSE_KEEPALIVE_SECONDS)
+                if changes:
+                    yield f"event: inventory\ndata: {json.dumps(changes)}\n\n"
+                else:
+                    # Comment line keeps proxies from closing an idle stream
+                    yield ": keepalive\n\n"
+        finally:
+            subscription.close()
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+@app.get("/agent/selection/stats")
+async def api_selection_stats():
+    """Prompt tokens and latency per tool subset vs. the full toolset"""
+    return selection_stats.snapshot(agent_cache.all_tools)
+
+@app.get("/events/stats")
+async def api_event_stats():
+    """Subscriber and event counts for the inventory feed"""
+    return inventory_events.stats()
+
+# Profiling (admin only)
+@app.post("/admin/profile/start", dependencies=[Depends(require_admin)])
+async def admin_profile_start(request: ProfileStartRequest):
+    """Start sampling for the next N requests or a time window"""
+    try:
+        sampling_profiler.start(request.requests, request.seconds, request.interval_ms)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return sampling_profiler.status()
+
+@app.post("/admin/profile/stop", dependencies=[Depends(require_admin)])
+async def admin_profile_stop():
+    sampling_profiler.stop()
+    return sampling_profiler.status()
+
+@app.get("/admin/profile/status", dependencies=[Depends(require_admin)])
+async def admin_profile_status():
+    return sampling_profiler.status()
+
+@app.get("/admin/profile/flamegraph", dependencies=[Depends(require_admin)])
+async def admin_profile_flamegraph():
+    """Collapsed stacks from the last sampling session (flamegraph.pl / speedscope input)"""
+    return PlainTextResponse(
+        sampling_profiler.collapsed(),
+        headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'}
+    )
+
+@app.get("/admin/profile/runs/{run_id}", dependencies=[Depends(require_admin)])
+async def admin_profile_run(run_id: str):
+    """cProfile report for a /chat request sent with an X-Profile header"""
+    report = request_profiles.get(run_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail=f"Profile run {run_id} not found")
+    return PlainTextResponse(report)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -3,7 +3,7 @@ Pydantic Models for Request/Response
 These define the "shapes" of data we send and receive
 """
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 
 # Book related models
@@ -17,6 +17,17 @@ class BookBase(BaseModel):
 class FindBooksRequest(BaseModel):
     q: str  # search query
     by: str = "title"  # search by "title" or "author"
+    all_branches: bool = False  # search every branch, not just the current one
+
+class FilterBooksRequest(BaseModel):
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    min_stock: Optional[int] = None
+    max_stock: Optional[int] = None
+    author: Optional[str] = None  # any part of the author's name
+    sort_by: str = "price"  # "price", "stock", "title" or "author"
+    order: str = "asc"  # "asc" or "desc"
+    limit: int = 20  # at most 100
 
 class BookResponse(BaseModel):
     isbn: str
@@ -69,6 +80,15 @@ class ToolCallRecord(BaseModel):
 class OrderStatusInput(BaseModel):
     order_id: int
 
+class BranchStockInput(BaseModel):
+    isbn: str
+
 class InventorySummaryInput(BaseModel):
     # No fields needed - empty input
-    pass
\ No newline at end of file
+    pass
+
+# Admin models
+class ProfileStartRequest(BaseModel):
+    requests: Optional[int] = Field(None, gt=0)  # profile the next N requests
+    seconds: Optional[float] = Field(None, gt=0)  # or everything for this many seconds
+    interval_ms: float = Field(5.0, gt=0)  # time between stack samples
\ No newline at end of file
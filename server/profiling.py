@@ -0,0 +1,218 @@
+"""
+On-demand profiling for the running server
+- Sampling profiler for the next N requests or a time window (collapsed stacks)
+- Deterministic cProfile of a single /chat request
+Nothing runs unless an admin turns it on.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from typing import Dict, Optional
+
+# Leaf frames that mean "this thread is idle", dropped from samples
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """
+    Background thread that snapshots every thread's Python stack at a fixed
+    interval and counts identical stacks (Brendan Gregg's collapsed format).
+    """
+
+    def __init__(self, max_depth: int = 128):
+        self.max_depth = max_depth
+        self.active = False
+        self.stacks = Counter()
+        self.samples = 0
+        self.interval = 0.005
+        self.requests_left: Optional[int] = None
+        self.until: Optional[float] = None
+        self.started_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
+        # Set to end the current sampler thread; each run gets its own
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, requests: Optional[int] = None, seconds: Optional[float] = None,
+              interval_ms: float = 5.0):
+        """Sample until `requests` more requests finish or `seconds` pass"""
+        if requests is None and seconds is None:
+            raise ValueError("Give a number of requests or a time window")
+        if requests is not None and requests <= 0:
+            raise ValueError("requests must be positive")
+        if seconds is not None and seconds <= 0:
+            raise ValueError("seconds must be positive")
+        if interval_ms <= 0:
+            raise ValueError("interval_ms must be positive")
+        self.stop()
+        stop_event = threading.Event()
+        with self._lock:
+            self._stop_event = stop_event
+            self.stacks = Counter()
+            self.samples = 0
+            self.interval = interval_ms / 1000
+            self.requests_left = requests
+            self.until = time.monotonic() + seconds if seconds is not None else None
+            self.started_at = time.time()
+            self.stopped_at = None
+            self.active = True
+        threading.Thread(target=self._run, args=(stop_event,),
+                         name="sampling-profiler", daemon=True).start()
+
+    def stop(self):
+        """
+        Stop sampling. Only signals the sampler thread, never waits for it,
+        since this runs from the middleware on the event loop
+        """
+        with self._lock:
+            if not self.active:
+                return
+            self.active = False
+            self.stopped_at = time.time()
+            self._stop_event.set()
+
+    def request_finished(self):
+        """Called by the middleware after each request while profiling"""
+        if self.requests_left is None:
+            return
+        with self._lock:
+            self.requests_left -= 1
+            done = self.requests_left <= 0
+        if done:
+            self.stop()
+
+    def _run(self, stop_event: threading.Event):
+        own_id = threading.get_ident()
+        interval, until = self.interval, self.until
+        while not stop_event.is_set():
+            if until is not None and time.monotonic() >= until:
+                self._expire(stop_event)
+                break
+            self._sample(own_id, stop_event)
+            stop_event.wait(interval)
+
+    def _expire(self, stop_event: threading.Event):
+        """End a run whose time window passed, unless a newer run replaced it"""
+        with self._lock:
+            if stop_event is not self._stop_event or not self.active:
+                return
+            self.active = False
+            self.stopped_at = time.time()
+            stop_event.set()
+
+    def _sample(self, own_id: int, stop_event: threading.Event):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+            labels = []
+            while frame is not None and len(labels) < self.max_depth:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            stack = ";".join(reversed(labels))
+            with self._lock:
+                # A stopped run must not add to the stacks of the next one
+                if stop_event.is_set():
+                    return
+                self.stacks[stack] += 1
+                self.samples += 1
+
+    def collapsed(self) -> str:
+        """Stacks as 'root;child;leaf count' lines, ready for flamegraph.pl or speedscope"""
+        with self._lock:
+            items = self.stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in items)
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                'active': self.active,
+                'samples': self.samples,
+                'unique_stacks': len(self.stacks),
+                'interval_ms': self.interval * 1000,
+                'requests_left': self.requests_left,
+                'seconds_left': (round(max(0.0, self.until - time.monotonic()), 1)
+                                 if self.active and self.until else None),
+                'started_at': self.started_at,
+                'stopped_at': self.stopped_at,
+            }
+
+
+class RequestProfiles:
+    """cProfile runs of single requests, keeping the most recent few"""
+
+    def __init__(self, keep: int = 20):
+        self.keep = keep
+        self.runs: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def profile(self, func, *args, **kwargs):
+        """Run func under cProfile; returns (result, run_id)"""
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            run_id = self._store(profiler)
+        return result, run_id
+
+    def _store(self, profiler: cProfile.Profile) -> str:
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats("cumulative").print_stats(60)
+        run_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            self.runs[run_id] = out.getvalue()
+            while len(self.runs) > self.keep:
+                self.runs.popitem(last=False)
+        return run_id
+
+    def get(self, run_id: str) -> Optional[str]:
+        with self._lock:
+            return self.runs.get(run_id)
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware counting finished requests for the sampler.
+    When profiling is off it is a single attribute check per request.
+    """
+
+    def __init__(self, app, profiler: SamplingProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if (not self.profiler.active or scope["type"] != "http"
+                or scope["path"].startswith("/admin/")):
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.profiler.request_finished()
+
+
+# Shared instances for the server
+sampling_profiler = SamplingProfiler()
+request_profiles = RequestProfiles()
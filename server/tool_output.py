@@ -0,0 +1,95 @@
+"""
+Output shaping for agent tools
+Trims what a tool returns before it reaches the LLM: only the columns the agent
+needs, the top rows plus a "more" count, and compact JSON. The direct /tools/*
+endpoints call the tools themselves and still get full results.
+"""
+
+import json
+import os
+from functools import wraps
+from typing import Any, Callable, Dict, List
+
+# Rows of a list result the agent sees before the rest is summarized as "more"
+TOP_K = int(os.getenv("TOOL_OUTPUT_TOP_K", "10"))
+
+BOOK_COLUMNS = ["isbn", "title", "author", "price", "stock", "branch"]
+
+# Per tool: which fields of a dict result to keep, and how to shape its lists.
+# "rows" describes a result that is itself a list.
+TOOL_OUTPUT_SPECS = {
+    # A list for one branch; {"books", "failed_branches"} with all_branches
+    "find_books": {"rows": BOOK_COLUMNS, "lists": {"books": BOOK_COLUMNS}},
+    "filter_books": {"rows": BOOK_COLUMNS},
+    "order_status": {
+        "fields": ["id", "status", "total_amount", "customer_name", "items"],
+        "lists": {"items": ["isbn", "title", "quantity", "unit_price"]},
+    },
+    "inventory_summary": {
+        "fields": ["low_stock_books", "count"],
+        "lists": {"low_stock_books": ["isbn", "title", "stock"]},
+    },
+    "branch_stock": {
+        "fields": ["isbn", "title", "branches", "total_stock", "failed_branches"],
+        "lists": {"branches": ["branch", "stock", "price"]},
+    },
+}
+
+
+class ShapedOutput(str):
+    """A tool result that is already compact JSON (so it is stored without re-encoding)"""
+
+
+def compact_json(value: Any) -> str:
+    """JSON without extra whitespace"""
+    return json.dumps(value, separators=(",", ":"), default=str)
+
+
+def table(rows: List[Dict], columns: List[str], top_k: int = TOP_K) -> Dict:
+    """
+    Rows as {"columns": [...], "rows": [[...], ...]} so keys aren't repeated per row.
+    Only columns that appear in the rows are kept; rows past top_k become a "more" count.
+    """
+    present = [column for column in columns if any(column in row for row in rows)]
+    shaped = {
+        "columns": present,
+        "rows": [[row.get(column) for column in present] for row in rows[:top_k]],
+    }
+    if len(rows) > top_k:
+        shaped["more"] = len(rows) - top_k
+    return shaped
+
+
+def shape_output(tool_name: str, result: Any) -> Any:
+    """Project and truncate a tool result according to its spec"""
+    spec = TOOL_OUTPUT_SPECS.get(tool_name)
+    if spec is None:
+        return result
+
+    if isinstance(result, list):
+        if "rows" in spec and all(isinstance(row, dict) for row in result):
+            return table(result, spec["rows"])
+        return result
+
+    if isinstance(result, dict):
+        # Errors go through untouched so the agent sees the message
+        if "error" in result:
+            return result
+        fields = spec.get("fields")
+        shaped = {key: value for key, value in result.items() if fields is None or key in fields}
+        for key, columns in spec.get("lists", {}).items():
+            if isinstance(shaped.get(key), list):
+                shaped[key] = table(shaped[key], columns)
+        return shaped
+
+    return result
+
+
+def shaped_tool(tool_name: str, func: Callable) -> Callable:
+    """Wrap a tool function so the agent gets a shaped, compact string"""
+
+    @wraps(func)
+    def wrapper(**kwargs):
+        return ShapedOutput(compact_json(shape_output(tool_name, func(**kwargs))))
+
+    return wrapper
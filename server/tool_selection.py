@@ -0,0 +1,145 @@
+"""
+Per-turn tool selection
+Scores each tool against the user's message (and the turn before it) with local
+keyword rules, so the agent only gets the tools (and prompt sections) the turn
+is likely to need. compare_tool_selection.py measures the effect.
+"""
+
+import os
+import re
+import threading
+from typing import Dict, FrozenSet, Iterable
+
+# Set AGENT_TOOL_SELECTION=0 to always send every tool (the baseline to compare against)
+SELECTION_ENABLED = os.getenv("AGENT_TOOL_SELECTION", "1") != "0"
+
+# Word stems that point at each tool; a word matches if it starts with a stem
+TOOL_KEYWORDS = {
+    "find_books": ["book", "title", "author", "search", "find", "look", "list", "have", "written", "wrote", "by"],
+    "filter_books": ["under", "over", "below", "above", "cheap", "expensive", "price", "cost", "between",
+                     "least", "most", "sort", "less", "more", "than", "stock"],
+    "create_order": ["order", "sold", "sell", "buy", "bought", "purchase", "customer", "copies"],
+    "restock_book": ["restock", "add", "received", "delivery", "arrived", "copies", "inventory"],
+    "update_price": ["price", "cost", "change", "update", "set", "discount", "raise", "lower"],
+    "order_status": ["status", "order", "track", "shipped", "completed", "pending"],
+    "inventory_summary": ["low", "inventory", "running", "stock", "summary", "short", "out"],
+    "branch_stock": ["branch", "location", "store", "elsewhere", "other", "where"],
+}
+
+# Extra signals that a regex catches better than words
+TOOL_PATTERNS = {
+    "filter_books": [re.compile(r"\$\s*\d"), re.compile(r"\b\d+(\.\d+)?\s*(dollars|usd)\b")],
+    "order_status": [re.compile(r"\border\s*#?\s*\d+\b")],
+    "restock_book": [re.compile(r"\b97[89]-?\d")],
+    "update_price": [re.compile(r"\b97[89]-?\d")],
+}
+
+# Tools that the selected tool usually needs alongside it
+TOOL_COMPANIONS = {
+    "create_order": ["find_books"],
+    "restock_book": ["find_books"],
+    "update_price": ["find_books"],
+    "filter_books": ["find_books"],
+    "branch_stock": ["find_books"],
+}
+
+# Minimum score for a tool to be picked
+MIN_SCORE = 1
+
+_WORD = re.compile(r"[a-z]+")
+
+
+def score_tools(message: str) -> Dict[str, int]:
+    """Keyword and pattern hits for every tool"""
+    text = message.lower()
+    words = _WORD.findall(text)
+    scores = {}
+    for tool, stems in TOOL_KEYWORDS.items():
+        score = sum(1 for word in words if any(word.startswith(stem) for stem in stems))
+        score += sum(2 for pattern in TOOL_PATTERNS.get(tool, []) if pattern.search(text))
+        scores[tool] = score
+    return scores
+
+
+def select_tools(message: str, all_tools: Iterable[str], context: Iterable[str] = ()) -> FrozenSet[str]:
+    """
+    Pick the tools for this message.
+    `context` is the previous user and assistant turn: a follow-up like
+    "yes, set that up for Alice" gets the tools the earlier turn pointed at
+    (here create_order, from the assistant's order confirmation).
+    Falls back to every tool when selection is off or nothing matches.
+    """
+    all_tools = frozenset(all_tools)
+    if not SELECTION_ENABLED:
+        return all_tools
+
+    scores = score_tools("\n".join([*context, message]))
+    selected = {tool for tool, score in scores.items() if score >= MIN_SCORE and tool in all_tools}
+    if not selected:
+        return all_tools
+
+    for tool in list(selected):
+        selected.update(t for t in TOOL_COMPANIONS.get(tool, []) if t in all_tools)
+    return frozenset(selected)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token), good enough for comparisons"""
+    return max(1, len(text) // 4)
+
+
+class SelectionStats:
+    """Prompt size and latency per tool subset, compared with the full toolset"""
+
+    def __init__(self):
+        self.full_prompt_tokens = None
+        self.subsets: Dict[FrozenSet[str], Dict] = {}
+        self._lock = threading.Lock()
+
+    def register_subset(self, tool_names: FrozenSet[str], prompt_tokens: int, full: bool = False):
+        with self._lock:
+            if full:
+                self.full_prompt_tokens = prompt_tokens
+            self.subsets.setdefault(tool_names, {
+                'prompt_tokens': prompt_tokens, 'turns': 0, 'total_seconds': 0.0,
+            })
+
+    def record(self, tool_names: FrozenSet[str], seconds: float):
+        with self._lock:
+            entry = self.subsets.get(tool_names)
+            if entry is not None:
+                entry['turns'] += 1
+                entry['total_seconds'] += seconds
+
+    def snapshot(self, all_tools: FrozenSet[str]) -> Dict:
+        with self._lock:
+            subsets = []
+            turns = tokens = 0
+            full = self.subsets.get(all_tools)
+            for names, entry in self.subsets.items():
+                subsets.append({
+                    'tools': sorted(names),
+                    'prompt_tokens': entry['prompt_tokens'],
+                    'turns': entry['turns'],
+                    'avg_latency_ms': (round(entry['total_seconds'] / entry['turns'] * 1000, 1)
+                                       if entry['turns'] else None),
+                })
+                turns += entry['turns']
+                tokens += entry['turns'] * entry['prompt_tokens']
+
+            full_tokens = self.full_prompt_tokens
+            summary = {
+                'selection_enabled': SELECTION_ENABLED,
+                'full_prompt_tokens': full_tokens,
+                'turns': turns,
+                'avg_prompt_tokens': round(tokens / turns, 1) if turns else None,
+                'full_toolset_avg_latency_ms': (round(full['total_seconds'] / full['turns'] * 1000, 1)
+                                                if full and full['turns'] else None),
+            }
+            if turns and full_tokens:
+                summary['prompt_tokens_saved_pct'] = round(100 * (1 - tokens / (turns * full_tokens)), 1)
+            summary['subsets'] = sorted(subsets, key=lambda s: -s['turns'])
+            return summary
+
+
+selection_stats = SelectionStats()
@@ -3,40 +3,69 @@ Agent Tools - FIXED TO HANDLE PYDANTIC MODELS
 """
 
 from typing import Dict, Any, List
-from database import Database
+# Tools work on the shard of the branch the current request belongs to
+from branches import branch_router
+from idempotency import current_turn, request_fingerprint, run_idempotent
 from models import *
 
-db = Database()
-
 def find_books(**kwargs) -> List[Dict]:
     """
     Search for books by title or author
     
     Args:
-        **kwargs: Keyword arguments with 'q' (search query) and 'by' (search type)
+        **kwargs: Keyword arguments with 'q' (search query), 'by' (search type)
+                  and 'all_branches' (search every branch)
     
     Returns:
-        List of matching books
+        List of matching books; with all_branches, {'books': [...], 'failed_branches': [...]}
     """
     # Extract values from Pydantic model or dict
     if hasattr(kwargs.get('q', ''), 'q'):
         # It's a Pydantic model, extract the field
         query = kwargs['q'].q
         search_by = kwargs['q'].by
+        all_branches = kwargs['q'].all_branches
     else:
         # It's a regular dict
         query = kwargs.get('q', '')
         search_by = kwargs.get('by', 'title')
+        all_branches = kwargs.get('all_branches', False)
+    
+    # Search every branch at once, each result tagged with its branch;
+    # branches that couldn't be searched are listed so the agent can say so
+    if all_branches:
+        books, failed_branches = branch_router.find_books_all(query, search_by)
+        return {'books': books, 'failed_branches': failed_branches}
     
+    db = branch_router.get()
     books = db.find_books(query, search_by)
     return books
 
+def filter_books(**kwargs) -> Any:
+    """
+    Filter books by price and stock ranges and author, sorted and limited
+    
+    Args:
+        **kwargs: Keyword arguments matching FilterBooksRequest
+    
+    Returns:
+        List of matching books, or an error if the filters are invalid
+    """
+    # Validate the same way whether we got agent kwargs or a plain dict
+    filters = FilterBooksRequest(**kwargs)
+    
+    db = branch_router.get()
+    try:
+        return db.filter_books(**filters.model_dump())
+    except ValueError as e:
+        return {"error": str(e)}
+
 def create_order(**kwargs) -> Dict[str, Any]:
     """
     Create a new order for a customer
     
     Args:
-        **kwargs: Keyword arguments with 'customer_id' and 'items' (list of book items)
+        **kwargs: Keyword arguments with 'customer_id', 'items' (list of book items)
     
     Returns:
         Order details and updated stock info
@@ -61,6 +90,21 @@ def create_order(**kwargs) -> Dict[str, Any]:
             # It's a regular dict
             db_items.append({'isbn': item['isbn'], 'qty': item['qty']})
     
+    db = branch_router.get()
+    
+    # Inside a chat turn, the same order repeated (e.g. the agent retrying after
+    # a parsing error) gets the same key. The /tools/create_order endpoint
+    # applies the client's Idempotency-Key itself.
+    if current_turn.get():
+        payload = {'customer_id': customer_id, 'items': db_items}
+        idempotency_key = f"{current_turn.get()}:{request_fingerprint(payload)[:16]}"
+        result, _ = run_idempotent(db, "create_order", idempotency_key, payload,
+                                   lambda: _place_order(db, customer_id, db_items))
+        return result
+    return _place_order(db, customer_id, db_items)
+
+def _place_order(db, customer_id: int, db_items: List[Dict]) -> Dict[str, Any]:
+    """Create the order and collect the new stock levels"""
     order_id = db.create_order(customer_id, db_items)
     
     # Get the created order details
@@ -103,6 +147,7 @@ def restock_book(**kwargs) -> Dict[str, Any]:
         isbn = kwargs.get('isbn')
         qty = kwargs.get('qty')
     
+    db = branch_router.get()
     book = db.get_book(isbn)
     if not book:
         return {"error": f"Book with ISBN {isbn} not found"}
@@ -140,6 +185,7 @@ def update_price(**kwargs) -> Dict[str, Any]:
         isbn = kwargs.get('isbn')
         price = kwargs.get('price')
     
+    db = branch_router.get()
     book = db.get_book(isbn)
     if not book:
         return {"error": f"Book with ISBN {isbn} not found"}
@@ -174,6 +220,7 @@ def order_status(**kwargs) -> Dict[str, Any]:
         # It's a regular dict
         order_id = kwargs.get('order_id')
     
+    db = branch_router.get()
     order = db.get_order_status(order_id)
     if not order:
         return {"error": f"Order {order_id} not found"}
@@ -190,8 +237,36 @@ def inventory_summary(**kwargs) -> Dict[str, Any]:
     Returns:
         List of books with low stock
     """
+    db = branch_router.get()
     low_stock_books = db.get_inventory_summary()
     return {
         'low_stock_books': low_stock_books,
         'count': len(low_stock_books)
+    }
+
+def branch_stock(**kwargs) -> Dict[str, Any]:
+    """
+    Check a book's stock and price at every branch
+    
+    Args:
+        **kwargs: Keyword arguments with 'isbn'
+    
+    Returns:
+        Stock per branch, the total across branches and any branches that couldn't be checked
+    """
+    isbn = kwargs.get('isbn')
+    
+    branches, failed_branches = branch_router.stock_all(isbn)
+    if not branches:
+        error = f"Book with ISBN {isbn} not found at any branch"
+        if failed_branches:
+            error += f" (could not check: {', '.join(failed_branches)})"
+        return {"error": error}
+    
+    return {
+        'isbn': isbn,
+        'title': branches[0]['title'],
+        'branches': branches,
+        'total_stock': sum(b['stock'] for b in branches),
+        'failed_branches': failed_branches
     }
\ No newline at end of file
@@ -0,0 +1,36 @@
+"""
+Shared test setup
+The server modules import each other by bare name (run from server/), so put
+that directory on the path the same way
+"""
+
+import os
+import sqlite3
+import sys
+
+import pytest
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(PROJECT_ROOT, "server")
+if SERVER_DIR not in sys.path:
+    sys.path.insert(0, SERVER_DIR)
+
+
+def create_library_db(db_path: str, seed: bool = True) -> str:
+    """A fresh database from db/schema.sql (and db/seed.sql)"""
+    conn = sqlite3.connect(db_path)
+    with open(os.path.join(PROJECT_ROOT, "db", "schema.sql")) as f:
+        conn.executescript(f.read())
+    if seed:
+        with open(os.path.join(PROJECT_ROOT, "db", "seed.sql")) as f:
+            conn.executescript(f.read())
+    conn.commit()
+    conn.close()
+    return db_path
+
+
+@pytest.fixture
+def library_db(tmp_path):
+    """Database for a seeded copy of the library, so tests never touch db/library.db"""
+    from database import Database
+    return Database(create_library_db(str(tmp_path / "library.db")))
@@ -0,0 +1,44 @@
+"""
+Tests for cross-branch lookups over the branch shards
+"""
+
+import os
+
+import pytest
+
+import branches
+from branches import BranchRouter
+from conftest import create_library_db
+
+
+@pytest.fixture
+def router(tmp_path, monkeypatch):
+    """main and south are seeded; north was never created; east is an empty file"""
+    paths = {
+        "main": create_library_db(str(tmp_path / "main.db")),
+        "south": create_library_db(str(tmp_path / "south.db")),
+        "north": str(tmp_path / "missing" / "north.db"),
+        "east": str(tmp_path / "east.db"),
+    }
+    open(paths["east"], "w").close()
+    monkeypatch.setattr(branches, "branch_db_path", lambda branch_id: paths[branch_id])
+    return BranchRouter(["main", "north", "south", "east"])
+
+
+def test_find_books_all_skips_failed_branches(router):
+    books, failed = router.find_books_all("Clean", "title")
+    assert sorted(failed) == ["east", "north"]
+    assert {book["branch"] for book in books} == {"main", "south"}
+    assert not os.path.exists(os.path.dirname(branches.branch_db_path("north")))
+
+
+def test_stock_all_skips_failed_branches(router):
+    stock, failed = router.stock_all("978-0132350884")
+    assert sorted(failed) == ["east", "north"]
+    assert [row["branch"] for row in stock] == ["main", "south"]
+
+
+def test_single_branch_failure_is_reported(tmp_path, monkeypatch):
+    monkeypatch.setattr(branches, "branch_db_path", lambda branch_id: str(tmp_path / "none" / "x.db"))
+    results, failed = BranchRouter(["main"]).fan_out("get_book", "978-0132350884")
+    assert results == {} and failed == ["main"]
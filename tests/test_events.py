@@ -0,0 +1,38 @@
+"""
+Tests for the inventory event bus
+"""
+
+import asyncio
+
+from events import InventoryEventBus
+
+
+def test_updates_to_one_book_are_coalesced():
+    async def scenario():
+        bus = InventoryEventBus()
+        subscription = bus.subscribe(["111"])
+        bus.publish("111", branch="main", stock=5)
+        bus.publish("111", branch="main", stock=4)
+        bus.publish("222", branch="main", stock=1)
+        batch = await subscription.next_batch(coalesce=0, timeout=1)
+        subscription.close()
+        return batch
+
+    batch = asyncio.run(scenario())
+    assert len(batch) == 1
+    assert batch[0]["isbn"] == "111" and batch[0]["stock"] == 4
+
+
+def test_subscribe_keeps_a_firehose_subscription():
+    async def scenario():
+        bus = InventoryEventBus()
+        subscription = bus.subscribe()
+        subscription.subscribe(["111"])
+        bus.publish("222", branch="main", stock=3)
+        batch = await subscription.next_batch(coalesce=0, timeout=1)
+        subscription.close()
+        return subscription.isbns, batch
+
+    isbns, batch = asyncio.run(scenario())
+    assert isbns is None
+    assert [event["isbn"] for event in batch] == ["222"]
@@ -0,0 +1,72 @@
+"""
+Tests for filter_books: results, and that the query plans use the books indexes
+"""
+
+import sqlite3
+
+import pytest
+
+FILTER_DEFAULTS = dict(min_price=None, max_price=None, min_stock=None, max_stock=None,
+                       author=None, sort_by="price", order="asc", limit=20)
+
+
+def query_plan(db, **filters):
+    sql, params = db._filter_books_query(**{**FILTER_DEFAULTS, **filters})
+    conn = sqlite3.connect(db.db_path)
+    plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+    conn.close()
+    return plan
+
+
+@pytest.mark.parametrize("filters, index", [
+    # Price range, cheapest first: range scan on price, already in order
+    ({"max_price": 40}, "idx_books_price_stock"),
+    ({"min_price": 20, "max_price": 40, "min_stock": 5}, "idx_books_price_stock"),
+    ({"max_price": 40, "order": "desc"}, "idx_books_price_stock"),
+    # Stock range sorted by stock
+    ({"min_stock": 2, "max_stock": 10, "sort_by": "stock"}, "idx_books_stock_price"),
+    ({"min_stock": 5, "sort_by": "stock", "order": "desc"}, "idx_books_stock_price"),
+    # Author on top of a price range is checked on the rows of the range scan
+    ({"author": "martin", "max_price": 50}, "idx_books_price_stock"),
+    # No filters: walk the index of the sort column instead of sorting the table
+    ({"sort_by": "price"}, "idx_books_price_stock"),
+    ({"sort_by": "stock"}, "idx_books_stock_price"),
+])
+def test_query_plan_uses_index(library_db, filters, index):
+    plan = query_plan(library_db, **filters)
+    assert any(index in step for step in plan), plan
+    # The tie-breaker may sort equal keys, but never the whole result
+    assert "USE TEMP B-TREE FOR ORDER BY" not in plan
+
+
+def test_range_query_searches_rather_than_scans(library_db):
+    plan = query_plan(library_db, min_price=20, max_price=40)
+    assert any(step.startswith("SEARCH books USING INDEX idx_books_price_stock") for step in plan), plan
+
+
+def test_filters_and_sorting(library_db):
+    books = library_db.filter_books(max_price=40, min_stock=5, sort_by="price")
+    assert books
+    assert all(book["price"] <= 40 and book["stock"] >= 5 for book in books)
+    assert [book["price"] for book in books] == sorted(book["price"] for book in books)
+
+
+def test_author_matches_any_part_of_the_name(library_db):
+    books = library_db.filter_books(author="martin")
+    assert {book["title"] for book in books} >= {"Clean Code", "Clean Architecture"}
+    assert all("martin" in book["author"].lower() for book in books)
+
+
+def test_author_wildcards_are_literal(library_db):
+    assert library_db.filter_books(author="%") == []
+
+
+def test_limit_is_capped(library_db):
+    assert len(library_db.filter_books(limit=1)) == 1
+    sql, params = library_db._filter_books_query(**{**FILTER_DEFAULTS, "limit": 10_000})
+    assert params[-1] == library_db.FILTER_MAX_LIMIT
+
+
+def test_unknown_sort_column_is_rejected(library_db):
+    with pytest.raises(ValueError):
+        library_db.filter_books(sort_by="isbn; DROP TABLE books")
@@ -0,0 +1,118 @@
+"""
+Tests for idempotency keys: replay, conflicts, leases and the async variant
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import idempotency
+from idempotency import (IdempotencyConflict, request_fingerprint, run_idempotent,
+                         run_idempotent_async)
+
+
+class Counter:
+    """A func for run_idempotent that counts its executions"""
+
+    def __init__(self, result=None, delay=0.0, error=None):
+        self.calls = 0
+        self.result = result if result is not None else {"order_id": 1}
+        self.delay = delay
+        self.error = error
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return self.result
+
+
+def stored_row(db, key, scope="create_order"):
+    conn = db.get_connection()
+    row = conn.execute("SELECT status, expires_at FROM idempotency_keys WHERE scope = ? AND key = ?",
+                       (scope, key)).fetchone()
+    conn.close()
+    return row
+
+
+def test_repeat_returns_stored_result(library_db):
+    func = Counter()
+    assert run_idempotent(library_db, "create_order", "k1", {"a": 1}, func) == ({"order_id": 1}, False)
+    assert run_idempotent(library_db, "create_order", "k1", {"a": 1}, func) == ({"order_id": 1}, True)
+    assert func.calls == 1
+
+
+def test_key_reused_for_another_request(library_db):
+    run_idempotent(library_db, "create_order", "k1", {"a": 1}, Counter())
+    with pytest.raises(IdempotencyConflict):
+        run_idempotent(library_db, "create_order", "k1", {"a": 2}, Counter())
+
+
+def test_failure_releases_the_key(library_db):
+    with pytest.raises(ValueError):
+        run_idempotent(library_db, "create_order", "k1", {"a": 1}, Counter(error=ValueError("no stock")))
+    func = Counter()
+    assert run_idempotent(library_db, "create_order", "k1", {"a": 1}, func) == ({"order_id": 1}, False)
+
+
+def test_done_key_is_kept_for_the_ttl(library_db):
+    run_idempotent(library_db, "create_order", "k1", {"a": 1}, Counter())
+    status, expires_at = stored_row(library_db, "k1")
+    assert status == "done"
+    assert expires_at > time.time() + idempotency.TTL_SECONDS - 60
+
+
+def test_pending_key_of_a_dead_worker_is_taken_over(library_db, monkeypatch):
+    monkeypatch.setattr(idempotency, "WAIT_SECONDS", 5)
+    # A worker claimed the key and died: nothing renews its short lease
+    library_db.claim_idempotency_key("create_order", "k1", request_fingerprint({"a": 1}), 0.2)
+    assert stored_row(library_db, "k1")[0] == "pending"
+
+    func = Counter()
+    started = time.monotonic()
+    assert run_idempotent(library_db, "create_order", "k1", {"a": 1}, func) == ({"order_id": 1}, False)
+    assert func.calls == 1
+    assert time.monotonic() - started < 2
+
+
+def test_running_execution_keeps_its_lease(library_db, monkeypatch):
+    monkeypatch.setattr(idempotency, "LEASE_SECONDS", 0.15)
+    thread = threading.Thread(target=run_idempotent,
+                              args=(library_db, "create_order", "k1", {"a": 1}, Counter(delay=0.5)))
+    thread.start()
+    time.sleep(0.35)
+    # Well past the first lease, but it was renewed, so nobody can take the key
+    row = library_db.claim_idempotency_key("create_order", "k1", request_fingerprint({"a": 1}), 0.15)
+    assert row is not None and row["status"] == "pending"
+    thread.join()
+    assert stored_row(library_db, "k1")[0] == "done"
+
+
+def test_async_duplicates_run_once_without_blocking_the_loop(library_db):
+    func = Counter(delay=0.3)
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticking = asyncio.create_task(ticker())
+        results = await asyncio.gather(
+            run_idempotent_async(library_db, "chat", "turn-1", {"m": "hi"}, func),
+            run_idempotent_async(library_db, "chat", "turn-1", {"m": "hi"}, func),
+        )
+        ticking.cancel()
+        return results, ticks
+
+    results, ticks = asyncio.run(scenario())
+    assert func.calls == 1
+    assert sorted(replayed for _, replayed in results) == [False, True]
+    # The loop kept running while func slept in a worker thread
+    assert ticks >= 10
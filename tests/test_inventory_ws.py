@@ -0,0 +1,32 @@
+"""
+Tests for the inventory WebSocket commands
+The app is imported with a fake model, so no provider key is needed
+"""
+
+import os
+
+os.environ.setdefault("LLM_FAKE_MODELS", "fake:latency=0")
+
+from fastapi.testclient import TestClient
+
+from main import app
+
+ISBN = "978-0132350884"
+
+
+def test_bad_frames_are_rejected_and_the_connection_stays_open():
+    client = TestClient(app)
+    with client.websocket_connect(f"/ws/inventory?isbn={ISBN}") as websocket:
+        snapshot = websocket.receive_json()
+        assert snapshot["type"] == "snapshot"
+        assert [book["isbn"] for book in snapshot["books"]] == [ISBN]
+
+        for frame in ("[1]", "not json", '{"subscribe": "978-0134685991"}', '{"subscribe": [1]}', "{}"):
+            websocket.send_text(frame)
+            reply = websocket.receive_json()
+            assert reply["type"] == "error", frame
+
+        websocket.send_json({"subscribe": ["978-0134685991"]})
+        reply = websocket.receive_json()
+        assert reply["type"] == "snapshot"
+        assert [book["isbn"] for book in reply["books"]] == ["978-0134685991"]
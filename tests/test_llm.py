@@ -0,0 +1,157 @@
+"""
+Tests for the LLM router: deadline, hedging and circuit breaking
+Everything runs against FakeChatModel, so no provider is called
+"""
+
+import threading
+import time
+
+import pytest
+
+from llm import CircuitBreaker, FakeChatModel, LLMUnavailableError, ModelRouter
+
+
+def make_router(*models, **settings):
+    settings.setdefault("timeout", 2.0)
+    settings.setdefault("hedge_min_samples", 5)
+    return ModelRouter([(model.name, model) for model in models], **settings)
+
+
+def test_deadline_raises_unavailable():
+    router = make_router(FakeChatModel("slow", latency=1.0), timeout=0.2)
+    start = time.monotonic()
+    with pytest.raises(LLMUnavailableError):
+        router.invoke("hi")
+    assert time.monotonic() - start < 0.6
+    assert router.stats["slow"].timeouts == 1
+
+
+def test_error_falls_back_to_next_model():
+    router = make_router(FakeChatModel("broken", error_rate=1.0), FakeChatModel("ok", response="fine"))
+    assert router.invoke("hi").content == "fine"
+    assert router.stats["broken"].errors == 1
+
+
+def test_hedge_fires_after_percentile():
+    primary = FakeChatModel("primary", latency=0.5, response="primary")
+    backup = FakeChatModel("backup", latency=0.0, response="backup")
+    router = make_router(primary, backup, hedge_percentile=95)
+    # Primary has been answering in ~50ms, so it gets hedged well before 0.5s
+    for _ in range(5):
+        router.stats["primary"].record_success(0.05)
+
+    start = time.monotonic()
+    assert router.invoke("hi").content == "backup"
+    assert time.monotonic() - start < 0.3
+    assert router.stats["backup"].hedges == 1
+
+
+def test_no_hedge_without_enough_samples():
+    primary = FakeChatModel("primary", latency=0.1, response="primary")
+    router = make_router(primary, FakeChatModel("backup", response="backup"))
+    assert router.invoke("hi").content == "primary"
+    assert router.stats["backup"].calls == 0
+
+
+def test_errors_stay_out_of_the_latency_window():
+    router = make_router(FakeChatModel("broken", error_rate=1.0), FakeChatModel("ok"))
+    router.invoke("hi")
+    assert len(router.stats["broken"].latencies) == 0
+    assert router.stats["broken"].percentile(95) is None
+
+
+def test_breaker_open_half_open_closed():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.available()
+    assert not breaker.allow_request()
+
+    time.sleep(0.15)
+    # Checking doesn't take the trial slot
+    assert breaker.available()
+    assert breaker.state == "open"
+    assert breaker.allow_request()
+    assert breaker.state == "half_open"
+    # Only one trial at a time
+    assert not breaker.allow_request()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_failed_trial_reopens_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.1)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_unused_fallback_keeps_its_trial_slot():
+    primary = FakeChatModel("a", response="a")
+    fallback = FakeChatModel("b", response="b")
+    router = make_router(primary, fallback, failure_threshold=1, reset_timeout=0.05)
+    router.breakers["b"].record_failure()
+    time.sleep(0.1)
+
+    # b's cooldown has passed but a answers, so b is never launched
+    assert router.invoke("hi").content == "a"
+    assert router.breakers["b"].state == "open"
+
+    # When a fails, b still gets its trial call and closes again
+    primary.error_rate = 1.0
+    assert router.invoke("hi").content == "b"
+    assert router.breakers["b"].state == "closed"
+    assert router.stats["b"].calls == 1
+
+
+def test_all_circuits_open_still_tries():
+    router = make_router(FakeChatModel("a", response="a"), failure_threshold=1, reset_timeout=60)
+    router.breakers["a"].record_failure()
+    assert router.invoke("hi").content == "a"
+
+
+class CountingModel(FakeChatModel):
+    """Fake model that counts the calls that actually reach it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.invocations = 0
+        self._count_lock = threading.Lock()
+
+    def invoke(self, input, config=None, **kwargs):
+        with self._count_lock:
+            self.invocations += 1
+        return super().invoke(input, config, **kwargs)
+
+
+def test_queued_calls_are_not_charged_to_the_model():
+    model = CountingModel("m", latency=0.2)
+    # 2 workers for 8 concurrent callers: most calls queue behind the pool
+    router = make_router(model, timeout=0.5, max_concurrent_calls=1)
+    outcomes = []
+
+    def caller():
+        try:
+            router.invoke("hi")
+            outcomes.append("ok")
+        except LLMUnavailableError:
+            outcomes.append("unavailable")
+
+    callers = [threading.Thread(target=caller) for _ in range(8)]
+    for thread in callers:
+        thread.start()
+    for thread in callers:
+        thread.join()
+    time.sleep(0.5)
+
+    assert outcomes.count("ok") >= 2 and outcomes.count("unavailable") >= 2
+    # Only calls that were running at the deadline count as timeouts
+    assert router.stats["m"].timeouts <= 2
+    assert router.breakers["m"].state == "closed"
+    # Cancelled calls never run after their caller gave up
+    assert model.invocations == router.stats["m"].calls <= outcomes.count("ok") + 2
@@ -0,0 +1,51 @@
+"""
+Tests for the sampling profiler
+"""
+
+import threading
+import time
+
+import pytest
+from pydantic import ValidationError
+
+from models import ProfileStartRequest
+from profiling import SamplingProfiler
+
+
+def busy(seconds: float):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+@pytest.mark.parametrize("settings", [
+    {"seconds": 0}, {"seconds": -1}, {"requests": 0}, {"seconds": 1, "interval_ms": -5},
+])
+def test_non_positive_settings_are_rejected(settings):
+    with pytest.raises(ValidationError):
+        ProfileStartRequest(**settings)
+    with pytest.raises(ValueError):
+        SamplingProfiler().start(**settings)
+
+
+def test_time_window_ends_by_itself():
+    profiler = SamplingProfiler()
+    worker = threading.Thread(target=busy, args=(0.3,))
+    worker.start()
+    profiler.start(seconds=0.1, interval_ms=1)
+    worker.join()
+    assert not profiler.active
+    assert profiler.samples > 0
+    assert "test_profiling.py:busy" in profiler.collapsed()
+
+
+def test_request_count_stops_without_waiting_for_the_sampler():
+    profiler = SamplingProfiler()
+    # A long interval keeps the sampler asleep; stopping must not wait it out
+    profiler.start(requests=2, interval_ms=5000)
+    profiler.request_finished()
+    assert profiler.active
+    start = time.monotonic()
+    profiler.request_finished()
+    assert time.monotonic() - start < 0.1
+    assert not profiler.active
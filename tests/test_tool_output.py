@@ -0,0 +1,42 @@
+"""
+Tests for tool output shaping and how tool results are stored
+"""
+
+import json
+
+from tool_output import ShapedOutput, shape_output, shaped_tool, table
+
+
+def test_table_keeps_top_rows_and_counts_the_rest():
+    rows = [{"isbn": str(i), "title": f"Book {i}", "description": "long"} for i in range(12)]
+    shaped = table(rows, ["isbn", "title", "author"], top_k=10)
+    assert shaped["columns"] == ["isbn", "title"]
+    assert len(shaped["rows"]) == 10
+    assert shaped["more"] == 2
+
+
+def test_fields_are_projected_and_errors_pass_through():
+    shaped = shape_output("inventory_summary", {"low_stock_books": [], "count": 0, "debug": "x"})
+    assert "debug" not in shaped
+    assert shape_output("inventory_summary", {"error": "boom"}) == {"error": "boom"}
+
+
+def test_shaped_tool_returns_marked_compact_json():
+    tool = shaped_tool("find_books", lambda **kwargs: [{"isbn": "1", "title": "A", "price": 10}])
+    result = tool(q="A")
+    assert isinstance(result, ShapedOutput)
+    assert json.loads(result) == {"columns": ["isbn", "title", "price"], "rows": [["1", "A", 10]]}
+    assert " " not in result
+
+
+def test_only_shaped_output_is_stored_as_is(library_db):
+    shaped = shaped_tool("order_status", lambda **kwargs: {"id": 1, "status": "done"})(order_id=1)
+    library_db.save_tool_call("s1", "order_status", {"order_id": 1}, shaped)
+    # e.g. the observation handle_parsing_errors adds, which is plain text
+    library_db.save_tool_call("s1", "_Exception", {}, "Invalid or incomplete response")
+
+    conn = library_db.get_connection()
+    stored = [row[0] for row in conn.execute("SELECT result_json FROM tool_calls ORDER BY id")]
+    conn.close()
+    assert [json.loads(value) for value in stored] == [{"id": 1, "status": "done"},
+                                                       "Invalid or incomplete response"]
@@ -0,0 +1,29 @@
+"""
+Tests for per-turn tool selection
+"""
+
+from tool_selection import TOOL_KEYWORDS, select_tools
+
+ALL_TOOLS = frozenset(TOOL_KEYWORDS)
+
+
+def test_clear_message_gets_a_subset():
+    selected = select_tools("What's the status of order #3?", ALL_TOOLS)
+    assert "order_status" in selected
+    assert selected != ALL_TOOLS
+
+
+def test_companion_tools_are_added():
+    selected = select_tools("Change the price of 978-0134685991 to 45.99", ALL_TOOLS)
+    assert {"update_price", "find_books"} <= selected
+
+
+def test_follow_up_uses_the_previous_turn():
+    context = ["Do you have The Pragmatic Programmer?",
+               "Yes, it's in stock. Would you like to order a copy?"]
+    assert "create_order" not in select_tools("Yes, set that up for Alice", ALL_TOOLS)
+    assert "create_order" in select_tools("Yes, set that up for Alice", ALL_TOOLS, context)
+
+
+def test_nothing_matched_falls_back_to_every_tool():
+    assert select_tools("Yes please", ALL_TOOLS) == ALL_TOOLS